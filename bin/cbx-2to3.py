@@ -4,26 +4,1037 @@
 """ Data filter converting CSTBox v2 event logs to v3 format.
 
 Usage: ./cbx-2to3.py < /path/to/input/file > /path/to/output/file
+       ./cbx-2to3.py [-j JOBS] [-s CHUNK_SIZE] [-o OUTPUT] FILE...
+
+When input files are given on the command line, each one is split in newline aligned
+chunks which are converted concurrently by a pool of worker processes. Converted chunks
+are written in their original order, so that the result is identical to the one
+produced by the filter mode.
+
+Files with a .gz, .bz2 or .xz extension (inputs and output) are decompressed or
+compressed on the fly. Plain input files are accessed through a memory map.
+
+With --columnar DIR, the converted events are stored in per-day and per-variable type
+partitions, using a columnar binary layout instead of the tab-separated text (NumPy
+is required in this case). Each partition is a DIR/YYYY-MM-DD/<var_type>/ directory
+containing :
+
+    ts.npy      event timestamps (datetime64[us])
+    name.npy    variable names, as indexes in names.json (int32)
+    names.json  dictionary of the partition variable names
+    value.npy   event values (float64, booleans being stored as 0 and 1)
+    text.json   raw value of the events which are not numeric, keyed by event index
+    data.jsonl  the JSON data field of the events, one per line
+
+so that reloading a column is a numpy.load() of the corresponding file.
+
+With --directory SRC_DIR, all the log files found in SRC_DIR are converted to files with
+the same relative path in the directory given by --output. A checkpoint file
+(.cbx-2to3.checkpoint) stored in the output directory records for each input file its
+inode, the offset up to which it has been converted and the timestamp of the last
+converted event. Subsequent runs convert only what has been appended to the input files
+since then, and resume from the last checkpoint if the previous run was interrupted.
+Files which have been replaced (inode change) or truncated are converted again from
+their start.
+
+Plain output files are completed by a sparse timestamp index (see
+cstbox_devtools.evtlog), with an entry every --index-every events.
+
+With --merge, the events of the input files are merged in timestamp order before being
+converted, using a k-way merge of the inputs. Inputs which are not in chronological order
+are first sorted externally : they are split in runs sorted in memory, using about
+--sort-buffer bytes each, and stored in temporary files which are merged with the other
+inputs. Files are merged at most MERGE_FAN_IN at a time, intermediate passes merging them
+into bigger runs when there are more, so that the memory used does not depend on the
+input size. --dedup discards the events which are exact duplicates of the previous one in
+the merged stream.
+
+The conversion itself is done by a cstbox_devtools.evtconv pipeline. Additional stages
+can be appended to the default v2 to v3 ones with --transform (e.g. -t rename:a=b
+-t drop:power.*), or replace them if --no-default-transforms is set. Stages registered by
+site specific modules can be used after loading these modules with --plugin.
+
+With --profile REPORT, statistics about the converted events (counts, time coverage,
+gaps and numeric values range of each variable) are gathered by the workers during the
+conversion itself and written as a JSON report (see cstbox_devtools.evtstats).
 """
 
 __author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
 
-import fileinput
+import sys
+import os
+import io
+import argparse
 import json
+import multiprocessing
+import mmap
+import gzip
+import bz2
+import zlib
+import time
+import heapq
+import tempfile
+import shutil
+import importlib
+from collections import OrderedDict
+
+# the libraries are used from the repository if they are not installed (see README.md)
+try:
+    import cstbox_devtools
+except ImportError:
+    sys.path.insert(0, os.path.join(
+        os.environ.get('CSTBOX_DEVEL_HOME') or os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'),
+        'src'
+    ))
+
+from cstbox_devtools import evtlog, evtconv, evtstats
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+DEFAULT_CHUNK_SIZE = 16 * 1024 * 1024
+DEFAULT_SORT_BUFFER = 256 * 1024 * 1024
+IO_BUFFER_SIZE = 1024 * 1024
+# maximum number of files merged at the same time, and read buffer size of the runs
+MERGE_FAN_IN = 32
+RUN_BUFFER_SIZE = 64 * 1024
+# memory used by a line kept for sorting a run, besides its characters : the string
+# object, its (timestamp, line) tuple, the timestamp and the list slot
+RUN_ENTRY_OVERHEAD = sys.getsizeof('') + sys.getsizeof((0., '')) + sys.getsizeof(0.) + 8
+
+STDIO = '-'
+MERGED = '<merged>'
+
+_pipeline = evtconv.Pipeline()
+_gap_threshold = None
+
+
+def _xz_file(path, mode):
+    if lzma is None:
+        raise IOError('xz support requires the lzma module (backports.lzma) : %s' % path)
+    return lzma.LZMAFile(path, mode)
+
+
+COMPRESSED_FILE_TYPES = {
+    '.gz': gzip.GzipFile,
+    '.bz2': bz2.BZ2File,
+    '.xz': _xz_file,
+}
+
+# errors raised by the decompressors on corrupt or truncated data
+DECOMPRESSION_ERRORS = (IOError, zlib.error, EOFError) + ((lzma.LZMAError,) if lzma else ())
+
+
+def is_compressed(path):
+    return os.path.splitext(path)[1].lower() in COMPRESSED_FILE_TYPES
+
+
+def open_log(path, mode='rb'):
+    """ Opens a log file for binary reading or writing, selecting the (de)compressor
+    from the file extension. The standard streams are used if path is '-'.
+    """
+    if path == STDIO:
+        stream = sys.stdin if 'r' in mode else sys.stdout
+        return io.open(stream.fileno(), mode, buffering=IO_BUFFER_SIZE, closefd=False)
+
+    ext = os.path.splitext(path)[1].lower()
+    if ext in COMPRESSED_FILE_TYPES:
+        return COMPRESSED_FILE_TYPES[ext](path, mode)
+
+    return io.open(path, mode, buffering=IO_BUFFER_SIZE)
+
+
+def init_conversion(specs, gap_threshold=None):
+    """ Sets the conversion pipeline used by this process, and enables the profiling of
+    converted events if a gap threshold is provided.
+
+    Used as the initializer of the pool worker processes.
+    """
+    global _pipeline, _gap_threshold
+    _pipeline = evtconv.Pipeline(specs)
+    _gap_threshold = gap_threshold
+
+
+def _profile(records):
+    if _gap_threshold is None:
+        return None
+    profile = evtstats.LogProfile(_gap_threshold)
+    profile.add_records(records)
+    return profile
+
+
+def mapped_chunks(path, chunk_size, start=0, size=None):
+    """ Generates the chunks of a plain file as (path, start, end, None) tuples, the
+    byte ranges being extended so that each one ends on a line boundary.
+
+    The optional start and size parameters restrict the processing to a part of the file.
+    """
+    if size is None:
+        size = os.path.getsize(path)
+    if size <= start:
+        return
+
+    with open(path, 'rb') as fp:
+        mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        while start < size:
+            end = mm.find('\n', start + chunk_size - 1, size)
+            end = size if end < 0 else end + 1
+            yield path, start, end, None
+            start = end
+    finally:
+        mm.close()
+
+
+def streamed_chunks(path, chunk_size):
+    """ Generates the chunks of a compressed file or of stdin as (path, start, end, text)
+    tuples, where offsets are relative to the decompressed content.
+    """
+    with open_log(path) as fp:
+        start = 0
+        while True:
+            try:
+                text = fp.read(chunk_size)
+                if text and not text.endswith('\n'):
+                    text += fp.readline()
+            except DECOMPRESSION_ERRORS as e:
+                raise IOError('%s: corrupt compressed data (%s)' % (path, e))
+            if not text:
+                break
+            end = start + len(text)
+            yield path, start, end, text
+            start = end
+
+
+def input_chunks(paths, chunk_size):
+    for path in paths:
+        if path == STDIO or is_compressed(path):
+            chunks = streamed_chunks(path, chunk_size)
+        else:
+            chunks = mapped_chunks(path, chunk_size)
+        for chunk in chunks:
+            yield chunk
+
+
+def _chunk_lines(chunk):
+    path, start, end, text = chunk
+    if text is None:
+        with open(path, 'rb') as fp:
+            mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            text = mm[start:end]
+        finally:
+            mm.close()
+
+    lines = text.split('\n')
+    if not lines[-1]:
+        lines.pop()
+    return len(text), lines
+
+
+def convert_chunk(chunk):
+    """ Converts a chunk of a v2 log file and returns the path of the file it belongs to,
+    the size of the source text, the v3 text and its profile if profiling is enabled.
+
+    Used as the worker function of the conversion pool.
+    """
+    path, start, end, _ = chunk
+    size, lines = _chunk_lines(chunk)
+    try:
+        if _gap_threshold is None:
+            return path, size, _pipeline.convert(lines), None
+        records = list(_pipeline.records(lines))
+        return path, size, ''.join(['\t'.join(record) + '\n' for record in records]), _profile(records)
+    except ValueError as e:
+        raise ValueError('%s: invalid record in range [%d-%d] (%s)' % (path, start, end, e))
+
+
+def parse_timestamp(value):
+    """ Returns the datetime64 corresponding to a timestamp, expressed either in ISO format
+    or as seconds since the epoch.
+    """
+    try:
+        return np.datetime64(value.replace(' ', 'T', 1), 'us')
+    except ValueError:
+        return np.datetime64(int(round(float(value) * 1e6)), 'us')
+
+
+def parse_timestamps(values):
+    """ Vectorized version of parse_timestamp, returning a datetime64 array.
+    """
+    try:
+        return np.array([v.replace(' ', 'T', 1) for v in values], dtype='datetime64[us]')
+    except ValueError:
+        return np.array([parse_timestamp(v) for v in values], dtype='datetime64[us]')
+
+
+def columnize_chunk(chunk):
+    """ Converts a chunk of a v2 log file and returns the path of the file it belongs to,
+    the size of the source text, the list of the partition slices built from it, as
+    (day, var_type, columns) tuples, and its profile if profiling is enabled.
+
+    Used as the worker function of the conversion pool in columnar mode.
+    """
+    path, start, end, _ = chunk
+    size, lines = _chunk_lines(chunk)
+    try:
+        records = list(_pipeline.records(lines))
+        days = np.datetime_as_string(parse_timestamps([r[0] for r in records]).astype('datetime64[D]'))
+    except ValueError as e:
+        raise ValueError('%s: invalid record in range [%d-%d] (%s)' % (path, start, end, e))
+
+    groups = {}
+    for i, record in enumerate(records):
+        groups.setdefault((days[i], record[1]), []).append(record)
+
+    slices = []
+    for (day, var_type), group in sorted(groups.iteritems()):
+        values = np.empty(len(group), dtype='float64')
+        texts = {}
+        for i, record in enumerate(group):
+            value = evtlog.parse_value(record[3])
+            if value is None:
+                values[i] = np.nan
+                texts[i] = record[3]
+            else:
+                values[i] = value
+        slices.append((day, var_type, {
+            'ts': parse_timestamps([r[0] for r in group]),
+            'name': [r[2] for r in group],
+            'value': values,
+            'text': texts,
+            'data': [r[4] for r in group]
+        }))
+
+    return path, size, slices, _profile(records)
+
+
+class ColumnarWriter(object):
+    """ Accumulates the partition slices produced by columnize_chunk and writes the
+    partitions on disk.
+
+    Slices are kept in memory until a slice of a later day is received, which limits
+    the memory usage to about one day of events when processing chronological logs.
+    Partitions which already exist on disk are appended to.
+    """
+    def __init__(self, root):
+        self._root = root
+        self._pending = {}
+
+    def add(self, slices):
+        if not slices:
+            return
+        for day, var_type, columns in slices:
+            self._pending.setdefault((day, var_type), []).append(columns)
+        self.flush(before=min(day for day, _, _ in slices))
+
+    def flush(self, before=None):
+        for key in sorted(self._pending):
+            if before is None or key[0] < before:
+                self._write(key, self._pending.pop(key))
+
+    def close(self):
+        self.flush()
+
+    def _write(self, key, slices):
+        part_dir = os.path.join(self._root, *key)
+        if not os.path.isdir(part_dir):
+            os.makedirs(part_dir)
+
+        def path_of(name):
+            return os.path.join(part_dir, name)
+
+        ts = [s['ts'] for s in slices]
+        names = [n for s in slices for n in s['name']]
+        values = [s['value'] for s in slices]
+        texts = {}
+        data = [d for s in slices for d in s['data']]
+
+        if os.path.exists(path_of('ts.npy')):
+            with open(path_of('names.json'), 'rt') as fp:
+                dictionary = json.load(fp)
+            with open(path_of('text.json'), 'rt') as fp:
+                texts = dict((int(k), v) for k, v in json.load(fp).iteritems())
+            ts.insert(0, np.load(path_of('ts.npy')))
+            names[:0] = [dictionary[code] for code in np.load(path_of('name.npy'))]
+            values.insert(0, np.load(path_of('value.npy')))
+
+        offset = len(names) - len(data)
+        for s in slices:
+            for i, text in s['text'].iteritems():
+                texts[offset + i] = text
+            offset += len(s['name'])
+
+        dictionary, codes = np.unique(np.array(names, dtype=object), return_inverse=True)
+
+        np.save(path_of('ts.npy'), np.concatenate(ts))
+        np.save(path_of('name.npy'), codes.astype('int32'))
+        np.save(path_of('value.npy'), np.concatenate(values))
+        with open(path_of('names.json'), 'wt') as fp:
+            json.dump(list(dictionary), fp)
+        with open(path_of('text.json'), 'wt') as fp:
+            json.dump(texts, fp)
+        with open(path_of('data.jsonl'), 'ab') as fp:
+            fp.write(''.join(d + '\n' for d in data))
+
+
+def pool_map(worker, chunks, jobs):
+    """ Applies the worker function to the chunks, using a process pool if more than one
+    job is requested, and generates the results in the chunks order.
+
+    Errors raised by the chunks generator are raised once the results of the chunks
+    generated before have been produced (Pool.imap would silently stop on them).
+    """
+    if jobs == 1:
+        for chunk in chunks:
+            yield worker(chunk)
+        return
+
+    errors = []
+
+    def guarded(chunks):
+        try:
+            for chunk in chunks:
+                yield chunk
+        except Exception: #pylint: disable=W0703
+            errors.append(sys.exc_info())
+
+    pool = multiprocessing.Pool(jobs, init_conversion, (_pipeline.specs, _gap_threshold))
+    try:
+        for result in pool.imap(worker, guarded(chunks)):
+            yield result
+        if errors:
+            exc_type, exc_value, exc_tb = errors[0]
+            raise exc_type, exc_value, exc_tb
+        pool.close()
+
+    except:
+        pool.terminate()
+        raise
+
+    finally:
+        pool.join()
+
+
+def _update_stats(stats, path, size_in, size_out, since):
+    now = time.time()
+    path_stats = stats.setdefault(path, [0, 0, 0.])
+    path_stats[0] += size_in
+    path_stats[1] += size_out
+    path_stats[2] += now - since
+    return now
+
 
-for line in fileinput.input():
-    ts, var_type, var_name, value, data = line.split('\t')
+def _is_indexable(path, index_every):
+    return index_every and path != STDIO and not is_compressed(path)
 
-    # next 3 lines are specific to Actility box at home files conversion
-    if var_name.startswith('home.'):
-        var_name = var_name[5:]
-    var_name = '.'.join((var_type, var_name))
 
-    data = data.strip().strip('{}')
-    if data:
-        pairs = data.split(',')
-        data = json.dumps(dict([(k.lower(), v) for k, v in (pair.split('=') for pair in pairs)]))
+def convert_files(chunks, output, jobs, index_every=0, profile=None):
+    """ Converts the chunks of a list of files and returns the conversion statistics, as a
+    dictionary keyed by the input path and containing (bytes read, bytes written, elapsed
+    seconds) lists.
+
+    If index_every is not null, the output is indexed with this period, provided it is a
+    plain file. Chunk profiles are merged in profile if provided.
+    """
+    stats = OrderedDict()
+    index = None
+    if _is_indexable(output, index_every):
+        index = evtlog.IndexWriter(output + evtlog.INDEX_SUFFIX, index_every)
+    try:
+        with open_log(output, 'wb') as out:
+            offset = 0
+            last = time.time()
+            for path, size, text, chunk_profile in pool_map(convert_chunk, chunks, jobs):
+                out.write(text)
+                if chunk_profile:
+                    profile.merge(chunk_profile)
+                if index:
+                    index.add(text, offset)
+                offset += len(text)
+                last = _update_stats(stats, path, size, len(text), last)
+
+    finally:
+        if index:
+            index.close()
+
+    return stats
+
+
+def convert_files_columnar(chunks, root, jobs, profile=None):
+    """ Same as convert_files, but stores the result as columnar partitions under the root
+    directory. The output size reported in statistics is the number of events.
+    """
+    if np is None:
+        raise IOError('columnar output requires NumPy')
+
+    stats = OrderedDict()
+    writer = ColumnarWriter(root)
+    last = time.time()
+    for path, size, slices, chunk_profile in pool_map(columnize_chunk, chunks, jobs):
+        writer.add(slices)
+        if chunk_profile:
+            profile.merge(chunk_profile)
+        last = _update_stats(stats, path, size, sum(len(s[2]['name']) for s in slices), last)
+    writer.close()
+
+    return stats
+
+
+def _lines(fp, path):
+    try:
+        for line in fp:
+            yield line
+    except DECOMPRESSION_ERRORS as e:
+        raise IOError('%s: corrupt compressed data (%s)' % (path, e))
+
+
+def _keyed_lines(fp, path):
+    """ Generates the (timestamp, line) tuples of the lines read from a file.
+    """
+    for line in _lines(fp, path):
+        if not line.endswith('\n'):
+            line += '\n'
+        try:
+            yield evtlog.parse_timestamp(line[:line.index('\t')]), line
+        except ValueError as e:
+            raise ValueError('%s: invalid record (%s)' % (path, e))
+
+
+def is_sorted(path):
+    """ Tells if the events of a file are in chronological order.
+    """
+    with open_log(path) as fp:
+        previous = None
+        for key in _keyed_lines(fp, path):
+            if key < previous:
+                return False
+            previous = key
+    return True
+
+
+def sorted_runs(path, buffer_size, tmp_dir):
+    """ Splits a file in sorted runs stored in temporary files, and returns the list of
+    their paths.
+
+    The memory used for sorting a run is kept below about buffer_size bytes, taking into
+    account the memory used by the (timestamp, line) tuple of each line and by the list
+    holding them (see RUN_ENTRY_OVERHEAD).
+    """
+    runs = []
+
+    def save_run(keys):
+        keys.sort()
+        fd, run_path = tempfile.mkstemp(suffix='.run', dir=tmp_dir)
+        with os.fdopen(fd, 'wb', IO_BUFFER_SIZE) as fp:
+            fp.writelines(line for _, line in keys)
+        runs.append(run_path)
+
+    with open_log(path) as fp:
+        keys, size = [], 0
+        for key in _keyed_lines(fp, path):
+            keys.append(key)
+            size += len(key[1]) + RUN_ENTRY_OVERHEAD
+            if size >= buffer_size:
+                save_run(keys)
+                keys, size = [], 0
+        if keys:
+            save_run(keys)
+
+    return runs
+
+
+def _merged_keys(paths, runs):
+    """ Generates the (timestamp, line) tuples of a list of sorted files, merged in
+    chronological order.
+
+    :param set runs: the paths of the temporary runs, which are read with a small buffer
+    """
+    files = []
+    try:
+        for path in paths:
+            files.append(io.open(path, 'rb', buffering=RUN_BUFFER_SIZE) if path in runs else open_log(path))
+        for key in heapq.merge(*[_keyed_lines(fp, path) for fp, path in zip(files, paths)]):
+            yield key
+    finally:
+        for fp in files:
+            fp.close()
+
+
+def _reduce_sources(sources, runs, tmp_dir):
+    """ Merges sorted files into runs, by groups of MERGE_FAN_IN, until no more than
+    MERGE_FAN_IN files are left, and returns their paths. Merged runs are deleted.
+    """
+    while len(sources) > MERGE_FAN_IN:
+        reduced = []
+        for i in range(0, len(sources), MERGE_FAN_IN):
+            group = sources[i:i + MERGE_FAN_IN]
+            if len(group) == 1:
+                reduced.extend(group)
+                continue
+
+            fd, run_path = tempfile.mkstemp(suffix='.run', dir=tmp_dir)
+            keys = _merged_keys(group, runs)
+            try:
+                with os.fdopen(fd, 'wb', IO_BUFFER_SIZE) as fp:
+                    fp.writelines(line for _, line in keys)
+            finally:
+                keys.close()
+            for path in group:
+                if path in runs:
+                    os.remove(path)
+                    runs.discard(path)
+            runs.add(run_path)
+            reduced.append(run_path)
+        sources = reduced
+    return sources
+
+
+def merged_lines(paths, dedup=False, buffer_size=DEFAULT_SORT_BUFFER, assume_sorted=False):
+    """ Generates the lines of a list of files, merged in chronological order.
+
+    Files which are not sorted are externally sorted first, unless assume_sorted is set.
+    Events are ordered by timestamp and then by content, so that identical events are
+    contiguous and dropped if dedup is set.
+    """
+    tmp_dir = tempfile.mkdtemp(prefix='cbx-2to3-')
+    keys = None
+    try:
+        sources = []
+        runs = set()
+        for path in paths:
+            if assume_sorted or is_sorted(path):
+                sources.append(path)
+            else:
+                file_runs = sorted_runs(path, buffer_size, tmp_dir)
+                sources.extend(file_runs)
+                runs.update(file_runs)
+
+        keys = _merged_keys(_reduce_sources(sources, runs, tmp_dir), runs)
+        previous = None
+        for _, line in keys:
+            if dedup and line == previous:
+                continue
+            previous = line
+            yield line
+
+    finally:
+        if keys:
+            keys.close()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def merged_chunks(lines, chunk_size):
+    """ Groups merged lines in chunks of about chunk_size bytes, as (path, start, end, text)
+    tuples.
+    """
+    start, block, size = 0, [], 0
+    for line in lines:
+        block.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            yield MERGED, start, start + size, ''.join(block)
+            start, block, size = start + size, [], 0
+    if block:
+        yield MERGED, start, start + size, ''.join(block)
+
+
+def last_line_end(path, start=0):
+    """ Returns the offset following the last complete line of a file, or start if no
+    line has been completed after it.
+    """
+    size = os.path.getsize(path)
+    if size <= start:
+        return start
+
+    with open(path, 'rb') as fp:
+        mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        return mm.rfind('\n', start) + 1 or start
+    finally:
+        mm.close()
+
+
+class Checkpoint(object):
+    """ Conversion progress of the files of a directory, persisted in the output directory.
+
+    Entries are keyed by the input file path relative to the source directory, and
+    contain its inode, the offset of the input already converted, the size of the
+    corresponding output and the timestamp of the last converted event. Compressed files
+    being processed as a whole, their entry also records the input size once completed.
+    """
+    FILE_NAME = '.cbx-2to3.checkpoint'
+
+    def __init__(self, directory):
+        self._path = os.path.join(directory, self.FILE_NAME)
+        try:
+            with open(self._path, 'rt') as fp:
+                self._entries = json.load(fp)
+        except IOError:
+            self._entries = {}
+
+    def get(self, name):
+        return self._entries.get(name)
+
+    def set(self, name, entry):
+        self._entries[name] = entry
+
+    def save(self):
+        """ Atomically replaces the checkpoint file.
+        """
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'wt') as fp:
+            json.dump(self._entries, fp, indent=1, sort_keys=True)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(tmp_path, self._path)
+
+
+def _directory_files(root):
+    for dir_path, dir_names, file_names in os.walk(root):
+        dir_names[:] = sorted(d for d in dir_names if not d.startswith('.'))
+        for name in sorted(file_names):
+            if not name.startswith('.'):
+                yield os.path.relpath(os.path.join(dir_path, name), root)
+
+
+def _plan_directory(src_dir, checkpoint):
+    """ Returns the list of (name, entry, start, end) describing the parts of the files
+    in the source directory which have not been converted yet.
+
+    end is None for compressed files, which are always converted as a whole.
+    """
+    plan = []
+    for name in _directory_files(src_dir):
+        path = os.path.join(src_dir, name)
+        st = os.stat(path)
+        entry = checkpoint.get(name)
+        if not entry or entry['inode'] != st.st_ino:
+            entry = {'inode': st.st_ino, 'offset': 0, 'out_offset': 0, 'records': 0, 'last_ts': None}
+
+        if is_compressed(path):
+            if entry.get('size') != st.st_size:
+                entry.update({'offset': 0, 'out_offset': 0, 'records': 0, 'size': None})
+                plan.append((name, entry, 0, None))
+        else:
+            if st.st_size < entry['offset']:
+                entry.update({'offset': 0, 'out_offset': 0, 'records': 0})
+            end = last_line_end(path, entry['offset'])
+            if end > entry['offset']:
+                plan.append((name, entry, entry['offset'], end))
+
+    return plan
+
+
+def convert_directory(src_dir, dst_dir, jobs, chunk_size, index_every=0, profile=None):
+    """ Incrementally converts the files of a directory, based on the checkpoint stored in
+    the output directory, which is updated after each converted chunk. A compressed file
+    whose conversion fails is not recorded as completed, and is converted again by the
+    next run.
+
+    Output files are indexed if index_every is not null. Chunk profiles are merged in
+    profile if provided.
+    """
+    if not os.path.isdir(dst_dir):
+        os.makedirs(dst_dir)
+    checkpoint = Checkpoint(dst_dir)
+    plan = _plan_directory(src_dir, checkpoint)
+    names = dict((os.path.join(src_dir, name), name) for name, _, _, _ in plan)
+    entries = dict((name, entry) for name, entry, _, _ in plan)
+
+    def chunks():
+        for name, entry, start, end in plan:
+            path = os.path.join(src_dir, name)
+            if end is None:
+                file_chunks = streamed_chunks(path, chunk_size)
+            else:
+                file_chunks = mapped_chunks(path, chunk_size, start, end)
+            for chunk in file_chunks:
+                yield chunk
+
+    def open_output(name):
+        out_path = os.path.join(dst_dir, name)
+        if is_compressed(out_path):
+            out_path = os.path.splitext(out_path)[0]
+        out_dir = os.path.dirname(out_path)
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        # get rid of what could have been written after the last checkpoint
+        entry = entries[name]
+        fp = open(out_path, 'r+b' if os.path.exists(out_path) else 'wb')
+        fp.truncate(entry['out_offset'])
+        fp.seek(0, os.SEEK_END)
+        index = None
+        if index_every:
+            index = evtlog.IndexWriter(
+                out_path + evtlog.INDEX_SUFFIX, index_every,
+                resume_at=entry['out_offset'], records=entry.get('records', 0)
+            )
+        return fp, index
+
+    def close_output(name, fp, index):
+        fp.close()
+        if index:
+            index.close()
+        path = os.path.join(src_dir, name)
+        if is_compressed(path):
+            entries[name]['size'] = os.path.getsize(path)
+            checkpoint.set(name, entries[name])
+            checkpoint.save()
+
+    stats = OrderedDict()
+    current, out, index = None, None, None
+    try:
+        last = time.time()
+        for path, size, text, chunk_profile in pool_map(convert_chunk, chunks(), jobs):
+            if chunk_profile:
+                profile.merge(chunk_profile)
+            name = names[path]
+            if name != current:
+                if out:
+                    close_output(current, out, index)
+                current, (out, index) = name, open_output(name)
+
+            entry = entries[name]
+            if index:
+                index.add(text, entry['out_offset'])
+                index.flush()
+                entry['records'] = index.records
+
+            out.write(text)
+            out.flush()
+            os.fsync(out.fileno())
+
+            entry['offset'] += size
+            entry['out_offset'] = out.tell()
+            if text:
+                entry['last_ts'] = text[text.rfind('\n', 0, -1) + 1:].split('\t', 1)[0]
+            checkpoint.set(name, entry)
+            checkpoint.save()
+
+            last = _update_stats(stats, path, size, len(text), last)
+
+        if out:
+            close_output(current, out, index)
+            out = None
+
+    finally:
+        if out:
+            out.close()
+        if index:
+            index.close()
+
+    return stats
+
+
+def report_stats(stats, output, events=False):
+    mb = 1024. * 1024.
+    for path, (size_in, size_out, elapsed) in stats.iteritems():
+        on_disk = ' (%.1f MB on disk)' % (os.path.getsize(path) / mb) if os.path.isfile(path) else ''
+        produced = '%d events' % size_out if events else '%.1f MB' % (size_out / mb)
+        sys.stderr.write('[STAT] %s%s: %.1f MB -> %s in %.2f s (%.1f MB/s)\n' % (
+            path, on_disk, size_in / mb, produced, elapsed, size_in / mb / elapsed if elapsed else 0
+        ))
+    if output != STDIO:
+        sys.stderr.write('[STAT] %s: %.1f MB on disk\n' % (output, os.path.getsize(output) / mb))
+
+
+def write_profile(profile, path):
+    if profile is None:
+        return
+    with open(path, 'wt') as fp:
+        json.dump(profile.as_dict(), fp, indent=2, sort_keys=True)
+
+
+def main(args):
+    for module in args.plugins:
+        importlib.import_module(module)
+    stages = [] if args.no_default_transforms else list(evtconv.V2_TO_V3_STAGES)
+    init_conversion(stages + args.transforms, args.gap_threshold if args.profile else None)
+    profile = evtstats.LogProfile(args.gap_threshold) if args.profile else None
+
+    if args.directory:
+        if args.files or args.columnar or args.merge or args.output == STDIO:
+            raise ValueError('--directory requires --output and excludes files, --columnar and --merge')
+        stats = convert_directory(
+            args.directory, args.output, args.jobs, args.chunk_size, args.index_every, profile
+        )
+        if args.stats:
+            report_stats(stats, STDIO)
+        write_profile(profile, args.profile)
+        return
+
+    if args.merge:
+        if not args.files:
+            raise ValueError('--merge requires input files')
+        lines = merged_lines(args.files, args.dedup, args.sort_buffer, args.assume_sorted)
+        chunks = merged_chunks(lines, args.chunk_size)
     else:
-        data = "{}"
+        chunks = input_chunks(args.files or [STDIO], args.chunk_size)
+
+    if args.columnar:
+        stats = convert_files_columnar(chunks, args.columnar, args.jobs, profile)
+        if args.stats:
+            report_stats(stats, STDIO, events=True)
+    else:
+        stats = convert_files(chunks, args.output, args.jobs, args.index_every, profile)
+        if args.stats:
+            report_stats(stats, args.output)
+    write_profile(profile, args.profile)
+
+
+if __name__ == '__main__':
+    _me = sys.modules[__name__]
+
+    def input_file(s):
+        if not os.path.isfile(s):
+            raise argparse.ArgumentTypeError('file not found (%s)' % s)
+        return s
+
+    def input_dir(s):
+        if not os.path.isdir(s):
+            raise argparse.ArgumentTypeError('directory not found (%s)' % s)
+        return s
+
+    def positive_int(s):
+        try:
+            n = int(s)
+            if n > 0:
+                return n
+        except ValueError:
+            pass
+        raise argparse.ArgumentTypeError('invalid positive integer (%s)' % s)
+
+    parser = argparse.ArgumentParser(
+        description=_me.__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+
+    parser.add_argument(
+        'files',
+        metavar='FILE',
+        nargs='*',
+        type=input_file,
+        help="v2 log file(s) to be converted (stdin is filtered if none)"
+    )
+    parser.add_argument(
+        '-d', '--directory',
+        metavar='SRC_DIR',
+        type=input_dir,
+        help="incrementally converts the log files of SRC_DIR into the --output directory"
+    )
+    parser.add_argument(
+        '-m', '--merge',
+        action='store_true',
+        help="merges the events of the input files in chronological order"
+    )
+    parser.add_argument(
+        '--dedup',
+        action='store_true',
+        help="discards duplicated events when merging"
+    )
+    parser.add_argument(
+        '--assume-sorted',
+        dest='assume_sorted',
+        action='store_true',
+        help="skips the chronological order check of merged files"
+    )
+    parser.add_argument(
+        '--sort-buffer',
+        dest='sort_buffer',
+        type=positive_int,
+        default=DEFAULT_SORT_BUFFER,
+        help="approximate memory size in bytes used for sorting the runs of the external "
+             "sort of unsorted merged files (default: %d)" % DEFAULT_SORT_BUFFER
+    )
+    parser.add_argument(
+        '-o', '--output',
+        default=STDIO,
+        help="output file, compressed according to its extension, or output directory "
+             "with --directory (default: stdout)"
+    )
+    parser.add_argument(
+        '-C', '--columnar',
+        metavar='DIR',
+        help="stores the result as columnar partitions in DIR instead of text"
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        type=positive_int,
+        default=multiprocessing.cpu_count(),
+        help="number of conversion processes (default: number of CPUs)"
+    )
+    parser.add_argument(
+        '-s', '--chunk-size',
+        dest='chunk_size',
+        type=positive_int,
+        default=DEFAULT_CHUNK_SIZE,
+        help="size in bytes of the chunks processed by workers (default: %d)" % DEFAULT_CHUNK_SIZE
+    )
+    parser.add_argument(
+        '-t', '--transform',
+        metavar='STAGE',
+        dest='transforms',
+        action='append',
+        default=[],
+        help="appends a conversion stage, specified as name[:arg[,arg...]] (available: %s)" %
+             ', '.join(evtconv.registered_stages())
+    )
+    parser.add_argument(
+        '-T', '--no-default-transforms',
+        dest='no_default_transforms',
+        action='store_true',
+        help="does not include the default v2 to v3 conversion stages (%s)" % ' '.join(evtconv.V2_TO_V3_STAGES)
+    )
+    parser.add_argument(
+        '--plugin',
+        metavar='MODULE',
+        dest='plugins',
+        action='append',
+        default=[],
+        help="imports a module registering additional conversion stages"
+    )
+    parser.add_argument(
+        '-I', '--index-every',
+        dest='index_every',
+        type=int,
+        default=evtlog.DEFAULT_INDEX_EVERY,
+        help="number of events between timestamp index entries of plain output files, "
+             "0 disabling the index (default: %d)" % evtlog.DEFAULT_INDEX_EVERY
+    )
+    parser.add_argument(
+        '-P', '--profile',
+        metavar='REPORT',
+        help="writes a JSON statistics profile of the converted events in REPORT"
+    )
+    parser.add_argument(
+        '--gap-threshold',
+        dest='gap_threshold',
+        type=positive_int,
+        default=evtstats.DEFAULT_GAP_THRESHOLD,
+        help="minimal interval in seconds between events of a variable reported as a gap "
+             "in the profile (default: %d)" % evtstats.DEFAULT_GAP_THRESHOLD
+    )
+    parser.add_argument(
+        '--stats',
+        action='store_true',
+        help="reports sizes and throughput of each processed file on stderr"
+    )
+
+    _args = parser.parse_args()
 
-    print('\t'.join((ts, var_type, var_name, value, data)))
+    try:
+        main(_args)
+    except (ValueError, IOError) as e:
+        sys.stderr.write('[ERR] %s\n' % e)
+        sys.exit(2)
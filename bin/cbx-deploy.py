@@ -8,6 +8,28 @@ import os
 import argparse
 import subprocess
 import time
+import shutil
+import zlib
+import re
+import sqlite3
+import signal
+import threading
+import tempfile
+import pipes
+from distutils.spawn import find_executable
+import Queue
+from multiprocessing.pool import ThreadPool
+
+# the libraries are used from the repository if they are not installed (see README.md)
+try:
+    import cstbox_devtools
+except ImportError:
+    sys.path.insert(0, os.path.join(
+        os.environ.get('CSTBOX_DEVEL_HOME') or os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'),
+        'src'
+    ))
+
+from cstbox_devtools import sshmux, deploydb, manifest
 
 
 class CTerm:
@@ -76,21 +98,141 @@ class CTerm:
         print('   ' + s + CTerm.RESET)
 
 
+class PackageReport(object):
+    """ Messages and commands output of a package deployment.
+
+    They are stored instead of being displayed, so that the reports of the builds and
+    uploads running concurrently can be displayed one at a time once completed.
+
+    Reports not related to a single package (package is None) are given a title.
+    """
+    def __init__(self, package, title=None):
+        self.package = package
+        self.title = title or "cstbox-" + package
+        self.lines = []
+        self.package_file = None
+        self.target = None
+        self.deployed = False
+        self.failed = False
+
+    def _emit(self, kind, msg):
+        self.lines.append((kind, msg))
+
+    def info(self, msg):
+        self._emit('info', msg)
+
+    def success(self, msg):
+        self._emit('success', msg)
+
+    def warn(self, msg):
+        self._emit('warn', msg)
+
+    def error(self, msg):
+        self._emit('error', msg)
+
+    def run(self, cmd, cwd=None, input=None):
+        """ Runs a shell command, its output being captured in the report.
+
+        :param str input: optional data sent to the command standard input
+        :returns: the command output
+        :raises subprocess.CalledProcessError: if the command fails
+        """
+        stdin = subprocess.PIPE if input is not None else None
+        process = subprocess.Popen(
+            cmd, shell=True, cwd=cwd, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+        )
+        output, _ = process.communicate(input)
+        self.lines.append((None, output))
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, cmd)
+        return output
+
+    def display(self):
+        CTerm.banner(self.title)
+        for kind, msg in self.lines:
+            if kind:
+                getattr(CTerm, kind)(msg)
+            else:
+                sys.stdout.write(msg)
+        sys.stdout.flush()
+
+
 TARGETS_ROOT = './targets'
 TARGET_STATUS_SUBDIR = 'status'
 TARGET_MIRROR_SUBDIR = 'mirror'
 TARGET_MIRROR_PKG = TARGET_MIRROR_SUBDIR + '/pkg'
 TARGET_MIRROR_CFG = TARGET_MIRROR_SUBDIR + '/cfg'
 DEPLOY_PATH_STORE = '.deploy_path'
+MIRROR_MANIFEST_CACHE = 'mirror.manifest'
 
 PACKAGES_CONFIG = "packages.cfg"
 
+# package source sub-directories ignored when checking if the package must be rebuilt
+BUILD_EXCLUDED_DIRS = ('build', 'dist')
+
+# timeout (in seconds) of the queries of the packages installed on targets
+DEFAULT_QUERY_TIMEOUT = 15
+# maximum number of targets queried concurrently
+MAX_CONCURRENT_QUERIES = 32
+
+# default maximum number of targets receiving packages at the same time
+DEFAULT_MAX_TARGETS = 4
+
+# deltas larger than this ratio of the package size are not worth being used
+DELTA_MAX_RATIO = 0.7
+
+# directory (relative to the deployment path) where the partial uploads are kept, so that
+# interrupted transfers are resumed by the next ones instead of being restarted
+PARTIAL_DIR = '.cbx-partial'
+# time (in seconds) without data exchange after which a transfer is aborted
+TRANSFER_IO_TIMEOUT = 60
+RSYNC_UPLOAD_OPTIONS = '-av --partial-dir=%s --timeout=%d' % (PARTIAL_DIR, TRANSFER_IO_TIMEOUT)
+# rsync exit codes of interrupted transfers (socket I/O, protocol stream, timeouts, ssh)
+RSYNC_RETRYABLE_CODES = (10, 12, 30, 35, 255)
+# default number of retries of interrupted transfers, and delay (in seconds) before the
+# first one, doubled for each of the next ones
+DEFAULT_TRANSFER_RETRIES = 3
+TRANSFER_RETRY_DELAY = 5
+
+# RTT measures older than this (in seconds) are refreshed by measuring the RTT again
+LINK_STATS_MAX_AGE = 24 * 3600
+# time (in seconds) allowed for the connection of the RTT measure
+LINK_PROBE_TIMEOUT = 10
+# transfers smaller than this (in bytes) are not used for measuring the throughput, since
+# their duration depends mostly on the RTT
+LINK_MIN_SAMPLE = 256 * 1024
+# weight of the last measure in the average throughput
+LINK_THROUGHPUT_WEIGHT = 0.3
+# line of the rsync --stats output giving the number of bytes actually sent
+RSYNC_BYTES_SENT_PATTERN = re.compile(r'^Total bytes sent: ([\d,.]+)', re.MULTILINE)
+# (minimum throughput in bytes/s, rsync compression level) from the fastest links, None
+# meaning no compression
+COMPRESSION_LEVELS = ((10e6, None), (1e6, 1), (100e3, 6), (0, 9))
+# compression level used when the throughput of a remote link has not been measured yet,
+# unless its RTT is below LAN_MAX_RTT (in seconds)
+DEFAULT_COMPRESSION_LEVEL = 6
+LAN_MAX_RTT = 0.005
+# files compressed to more than this ratio of their size (checked on a sample of their
+# content) are sent uncompressed
+INCOMPRESSIBLE_RATIO = 0.9
+COMPRESSIBILITY_SAMPLE = 64 * 1024
+# links slower than this (in bytes/s) are used up to a share of their throughput, so that
+# the deployment does not starve the target own traffic
+BWLIMIT_MAX_THROUGHPUT = 1e6
+BWLIMIT_SHARE = 0.8
+
+# cstbox-<name>_<version>_<arch>[-unstable].deb
+PACKAGE_FILE_PATTERN = re.compile(r'^cstbox-.+?_([^_]+)_[^_]+\.deb$')
+
 _packages = None
 
 _directory = None
 _targets = None
 _current_target = None
 
+# deployment state database
+_db = None
+
 # just for pylint not complaining since these vars are dynamically created
 CBX_GIT = CBX_DEPLOY_PATH = None
 
@@ -98,84 +240,781 @@ CBX_GIT = CBX_DEPLOY_PATH = None
 def _update_directory():
     global _directory, _targets, _current_target
 
-    _directory = {}
-    for name in os.listdir(TARGETS_ROOT):
-        _path = os.path.join(TARGETS_ROOT, name)
-        if os.path.isdir(_path):
-            deploy_path_store = os.path.join(_path, DEPLOY_PATH_STORE)
-            if os.path.exists(deploy_path_store):
-                deploy_path = file(deploy_path_store, 'rt').readline()
-                _directory[name] = deploy_path
-                if deploy_path == CBX_DEPLOY_PATH:
-                    _current_target = name
-
+    _directory = dict(_db.targets())
     _targets = sorted(_directory.keys())
+    _current_target = None
+    for name, deploy_path in _directory.iteritems():
+        if deploy_path == CBX_DEPLOY_PATH:
+            _current_target = name
+
+
+def _check_current_target():
+    if not _current_target:
+        raise ValueError("no target registered for CBX_DEPLOY_PATH=%s (see 'new' command)" % CBX_DEPLOY_PATH)
+
+
+class Target(object):
+    """ A deployment target.
+
+    While it is open, it provides the multiplexed SSH connection shared by the transfers
+    to the target.
+    """
+    def __init__(self, name, deploy_path):
+        self.name = name
+        self.deploy_path = deploy_path
+        self.host = sshmux.remote_host(deploy_path)
+        self.root = os.path.join(TARGETS_ROOT, name)
+        self.mirror_pkg = os.path.join(self.root, TARGET_MIRROR_PKG)
+        self.mirror_cfg = os.path.join(self.root, TARGET_MIRROR_CFG)
+        self.ssh = None
+
+    @property
+    def remote_dir(self):
+        """ The deployment directory on the remote host.
+        """
+        return self.deploy_path.split(':', 1)[1] or '.'
+
+    def open(self):
+        self.ssh = sshmux.for_path(self.deploy_path)
+        return self
+
+    def close(self):
+        if self.ssh:
+            self.ssh.close()
+            self.ssh = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _get_target(name=None):
+    """ Returns the target of a given name, or the current one if no name is given.
+
+    :raises ValueError: if the target is not registered
+    """
+    if name is None:
+        _check_current_target()
+        name = _current_target
+    try:
+        return Target(name, _directory[name])
+    except KeyError:
+        raise ValueError("unknown target : %s" % name)
+
+
+def _selected_targets(args):
+    """ Returns the targets selected by the --targets and --all-targets options, or the
+    current one by default.
+
+    The relay target, if any, is always part of the selection and comes first.
+    """
+    if args.all_targets:
+        if not _targets:
+            raise ValueError('no target defined')
+        targets = [_get_target(name) for name in _targets]
+    elif args.targets:
+        targets = [_get_target(name.strip()) for name in args.targets.split(',') if name.strip()]
+    else:
+        targets = [_get_target()]
+
+    if args.relay:
+        relay = _get_target(args.relay)
+        targets = [relay] + [t for t in targets if t.name != relay.name]
+    return targets
 
 
 def do_all(args):
     CTerm.header('deploying all packages...')
-    for package in _packages:
-        CTerm.banner("cstbox-" + package)
-        _deploy_package(package)
+    _deploy(args, _packages)
 
 
 def do_package(args):
     CTerm.header("deploying package cstbox-%s..." % args.package)
-    _deploy_package(args.package)
+    # a single package is built
+    args.jobs = 1
+    _deploy(args, [args.package])
+
+
+def _deploy(args, packages):
+    """ Deploys packages on the selected targets, building the missing or stale ones.
+
+    Builds and uploads are pipelined : up to args.jobs packages are built concurrently,
+    while an uploader thread per target sends the packages already built. Each upload
+    sends in a single transfer all the packages which have been built since the previous
+    one, so that when no build is needed all the changed packages are sent at once. At
+    most args.max_targets targets receive packages at the same time.
+
+    In relay mode, the packages are uploaded to the relay target only, which then
+    forwards them to the other targets (its siblings) over its own network, up to
+    args.max_targets siblings at the same time.
+
+    If args.order is set, the packages of each upload are sent one at a time, smallest
+    first or by priority (see :py:func:`_ordered`).
+    """
+    targets = _selected_targets(args)
+    fan_out = len(targets) > 1
+    if args.relay:
+        relay, siblings = targets[0], targets[1:]
+        direct_targets = [relay]
+    else:
+        relay, siblings = None, []
+        direct_targets = targets
+
+    def build(report):
+        try:
+            report.package_file = _build_package(report.package, report)
+        except Exception as e: #pylint: disable=W0703
+            report.failed = True
+            report.error(e)
+        return report
+
+    completed = Queue.Queue()
+    queues = dict((target.name, Queue.Queue()) for target in direct_targets)
+    transfer_slots = threading.BoundedSemaphore(args.max_targets)
+    forwarders = ThreadPool(args.max_targets) if siblings else None
+
+    def forward(sibling, reports):
+        """ Has the relay forward to a sibling the packages it has been sent.
+        """
+        sibling_reports = []
+        for report in reports:
+            sibling_report = PackageReport(
+                report.package,
+                title="cstbox-%s -> %s -> %s" % (report.package, relay.name, sibling.name)
+            )
+            sibling_report.package_file = report.package_file
+            sibling_report.target = sibling.name
+            if report.failed:
+                sibling_report.failed = True
+                sibling_report.error('not available on relay %s' % relay.name)
+            sibling_reports.append(sibling_report)
+
+        available = [r for r in sibling_reports if not r.failed]
+        transfer = None
+        if available:
+            try:
+                transfer = _upload_packages(
+                    sibling, available, relay=relay, retries=args.retries
+                )
+            except Exception as e: #pylint: disable=W0703
+                transfer = PackageReport(
+                    None, title="upload to %s via %s" % (sibling.name, relay.name)
+                )
+                transfer.error(e)
+                for report in available:
+                    report.failed = True
+        return transfer, sibling_reports
+
+    def report_upload(report, reported):
+        completed.put(('upload', report))
+        reported.add((report.package, report.target))
+
+    def send(target, reports, reported):
+        with transfer_slots:
+            try:
+                transfer = _upload_packages(
+                    target, reports, delta=args.delta, retries=args.retries, bwlimit=args.bwlimit
+                )
+            except Exception as e: #pylint: disable=W0703
+                transfer = PackageReport(None, title="upload to %s" % target.name)
+                transfer.error(e)
+                for report in reports:
+                    report.failed = True
+        if transfer:
+            completed.put(('transfer', transfer))
+        for report in reports:
+            report_upload(report, reported)
+        if target is relay and siblings:
+            for transfer, sibling_reports in forwarders.imap_unordered(
+                lambda sibling: forward(sibling, reports), siblings
+            ):
+                if transfer:
+                    completed.put(('transfer', transfer))
+                for report in sibling_reports:
+                    report_upload(report, reported)
+
+    def upload(target):
+        queue = queues[target.name]
+        while True:
+            reports = [queue.get()]
+            while True:
+                try:
+                    reports.append(queue.get_nowait())
+                except Queue.Empty:
+                    break
+            # None is the end of work signal
+            done = None in reports
+            reports = [r for r in reports if r]
+            # (package, target name) of the uploads already reported as completed
+            reported = set()
+            try:
+                if reports and args.order:
+                    # packages sent one at a time, so that they are deployed in the requested order
+                    for report in _ordered(reports, args.order):
+                        send(target, [report], reported)
+                elif reports:
+                    send(target, reports, reported)
+            except Exception as e: #pylint: disable=W0703
+                # the uploads not reported yet are reported as failed, since the deployment
+                # waits for all of them
+                for report in reports:
+                    if (report.package, target.name) not in reported:
+                        report.failed = True
+                        report.error(e)
+                        report_upload(report, reported)
+                    for sibling in siblings if target is relay else []:
+                        if (report.package, sibling.name) not in reported:
+                            sibling_report = PackageReport(
+                                report.package,
+                                title="cstbox-%s -> %s -> %s" % (report.package, relay.name, sibling.name)
+                            )
+                            sibling_report.target = sibling.name
+                            sibling_report.failed = True
+                            sibling_report.error(e)
+                            report_upload(sibling_report, reported)
+            if done:
+                return
+
+    pending = {'builds': len(packages), 'uploads': 0}
+    build_failures = []
+    uploads = []
+
+    def dispatch(report):
+        """ Processes the result of a package build, handing the package file to the
+        uploaders if successful.
+        """
+        pending['builds'] -= 1
+        if report.failed:
+            report.display()
+            build_failures.append(report.package)
+            return
+
+        if fan_out and report.lines:
+            report.display()
+        for target in direct_targets:
+            if fan_out:
+                target_report = PackageReport(
+                    report.package, title="cstbox-%s -> %s" % (report.package, target.name)
+                )
+                target_report.package_file = report.package_file
+            else:
+                target_report = report
+            target_report.target = target.name
+            queues[target.name].put(target_report)
+        pending['uploads'] += len(targets)
+
+    # packages already built are queued before the uploaders are started, so that they
+    # are all sent in the first transfer
+    to_build = []
+    for package in packages:
+        report = PackageReport(package)
+        try:
+            if _needs_build(package):
+                to_build.append(report)
+                continue
+        except Exception as e: #pylint: disable=W0703
+            report.failed = True
+            report.error(e)
+        else:
+            build(report)
+        dispatch(report)
+
+    builders = ThreadPool(args.jobs)
+    uploaders = []
+    try:
+        for target in direct_targets:
+            target.open()
+            uploader = threading.Thread(target=upload, args=(target,))
+            uploader.daemon = True
+            uploader.start()
+            uploaders.append(uploader)
+
+        for report in to_build:
+            builders.apply_async(build, (report,), callback=lambda r: completed.put(('build', r)))
+
+        while pending['builds'] or pending['uploads']:
+            try:
+                # (timeout used to keep the wait interruptible)
+                kind, report = completed.get(timeout=1)
+            except Queue.Empty:
+                continue
+            if kind == 'build':
+                dispatch(report)
+            else:
+                report.display()
+                if kind == 'upload':
+                    pending['uploads'] -= 1
+                    uploads.append(report)
+
+    finally:
+        builders.close()
+        builders.join()
+        for target in direct_targets:
+            queues[target.name].put(None)
+        for uploader in uploaders:
+            uploader.join()
+        if forwarders:
+            forwarders.close()
+            forwarders.join()
+        for target in direct_targets:
+            target.close()
+
+    CTerm.header('summary')
+    failures = sorted(build_failures)
+    if fan_out:
+        SUMMARY_FORMAT = "%20s %10s %10s %10s"
+        CTerm.out(SUMMARY_FORMAT % ("Target", "Deployed", "Unchanged", "Failed"), CTerm.WHITE)
+        CTerm.out('-'*20 + (' ' + '-'*10) * 3, CTerm.WHITE)
+    for target in targets:
+        reports = [r for r in uploads if r.target == target.name]
+        deployed = sum(1 for r in reports if r.deployed)
+        failed = sum(1 for r in reports if r.failed) + len(build_failures)
+        unchanged = len(packages) - deployed - failed
+        failures.extend(sorted(
+            r.package + ('@' + target.name if fan_out else '') for r in reports if r.failed
+        ))
+        if fan_out:
+            print((CTerm.RED if failed else CTerm.GREEN) + SUMMARY_FORMAT % (
+                target.name, deployed, unchanged, failed
+            ) + CTerm.RESET)
+        else:
+            CTerm.value(
+                (CTerm.RED if failed else CTerm.GREEN) +
+                '%d deployed, %d unchanged, %d failed' % (deployed, unchanged, failed)
+            )
+
+    if failures:
+        raise Exception("deployment failed for : %s" % ', '.join(failures))
+    CTerm.success('all packages deployed')
 
 
-def _deploy_package(package):
+def _ordered(reports, order):
+    """ Sorts package reports, either smallest package file first ('smallest') or by
+    priority ('priority'), which is the order of the packages in the configuration.
+    """
+    if order == 'smallest':
+        key = lambda r: os.path.getsize(r.package_file)
+    else:
+        key = lambda r: _packages.index(r.package) if r.package in _packages else len(_packages)
+    return sorted(reports, key=key)
+
+
+def _is_stale(package_src_dir, package_link):
+    """ Tells if some source file of a package is more recent than its distribution
+    package.
+    """
+    built = os.path.getmtime(package_link)
+    for dir_path, dir_names, file_names in os.walk(package_src_dir):
+        dir_names[:] = [d for d in dir_names if d not in BUILD_EXCLUDED_DIRS and not d.startswith('.')]
+        for name in file_names:
+            if name.endswith('.deb') or name.startswith('.'):
+                continue
+            if os.lstat(os.path.join(dir_path, name)).st_mtime > built:
+                return True
+    return False
+
+
+def _package_paths(package):
+    """ Returns the source directory of a package and the path of its distribution
+    package link.
+    """
     package_src_dir = os.path.join(CBX_GIT, package)
     if not os.path.exists(package_src_dir):
         raise ValueError("package directory not found : %s" % package_src_dir)
 
-    package_link = os.path.join(package_src_dir, "cstbox-%s.deb" % package)
+    return package_src_dir, os.path.join(package_src_dir, "cstbox-%s.deb" % package)
+
+
+def _needs_build(package):
+    """ Tells if the distribution package does not exist yet or is older than its sources.
+    """
+    package_src_dir, package_link = _package_paths(package)
+    return not os.path.exists(package_link) or _is_stale(package_src_dir, package_link)
 
-    target_root = os.path.join(TARGETS_ROOT, _current_target)
-    status_file = os.path.join(target_root, TARGET_STATUS_SUBDIR, package)
-    try:
-        last_deployed = os.path.getmtime(status_file)
-    except os.error:
-        last_deployed = 0
 
-    if not os.path.exists(package_link):
-        CTerm.info('creating distribution package...')
-        cwd = os.getcwd()
+def _build_package(package, report):
+    """ Builds the distribution package if needed, and returns the path of the package
+    file.
+    """
+    package_src_dir, package_link = _package_paths(package)
+
+    if _needs_build(package):
+        report.info('creating distribution package...')
         try:
-            os.chdir(package_src_dir)
-            subprocess.check_call("make dist", shell=True)
+            report.run("make dist", cwd=package_src_dir)
 
         except subprocess.CalledProcessError as e:
             raise Exception(
                 "%s failed with return code %d" % (e.cmd, e.returncode)
             )
 
-        finally:
-            os.chdir(cwd)
-
-    last_modified = os.path.getmtime(package_link)
-    package_file = os.path.join(
+    return os.path.join(
         os.path.dirname(package_link),
         os.readlink(package_link)
     )
 
-    if last_modified > last_deployed:
-        CTerm.info('deploying distribution package...')
-        subprocess.check_call(
-            "rsync -av %s %s" % (package_file, CBX_DEPLOY_PATH),
-            shell=True
+
+def _package_version(package_file):
+    m = PACKAGE_FILE_PATTERN.match(os.path.basename(package_file))
+    return m.group(1) if m else None
+
+
+def _is_deployed(status, package_file, digest):
+    """ Tells if a package file is the one which has been deployed, by comparing their
+    digests, or their dates for deployments imported without digest.
+    """
+    if not status:
+        return False
+    if status['digest']:
+        return status['digest'] == digest
+    return os.path.getmtime(package_file) <= status['deployed']
+
+
+def _link_stats(target):
+    """ Returns the statistics of the link with a remote target, measuring its RTT if
+    it is unknown or outdated.
+    """
+    stats = _db.link_stats(target.name)
+    if stats and stats['rtt_updated'] and time.time() - stats['rtt_updated'] < LINK_STATS_MAX_AGE:
+        return stats
+
+    rtt = None
+    with open(os.devnull, 'wb') as devnull:
+        # the first command opens the multiplexed connection, the second one measures the RTT
+        for _ in range(2):
+            started = time.time()
+            if subprocess.call(
+                "%s -o ConnectTimeout=%d %s true" % (target.ssh.ssh_command, LINK_PROBE_TIMEOUT, target.host),
+                shell=True, stdout=devnull, stderr=devnull
+            ):
+                break
+        else:
+            rtt = time.time() - started
+    if rtt is not None:
+        _db.record_link_stats(target.name, rtt=rtt)
+    return _db.link_stats(target.name) or {'rtt': None, 'throughput': None}
+
+
+def _record_throughput(target, output, duration):
+    """ Updates the average throughput of the link with a target, given the output of an
+    rsync transfer run with --stats and its duration.
+
+    The number of bytes actually sent is used, so that files skipped by rsync, resumed
+    partial uploads and compression do not make the link look faster than it is.
+    """
+    m = RSYNC_BYTES_SENT_PATTERN.search(output or '')
+    if not m or duration <= 0:
+        return
+    size = int(re.sub(r'\D', '', m.group(1)))
+    if size < LINK_MIN_SAMPLE:
+        return
+    stats = _db.link_stats(target.name)
+    throughput = size / duration
+    if stats and stats['throughput']:
+        throughput = LINK_THROUGHPUT_WEIGHT * throughput + (1 - LINK_THROUGHPUT_WEIGHT) * stats['throughput']
+    _db.record_link_stats(target.name, throughput=throughput)
+
+
+def _compressibility(paths):
+    """ Returns the ratio of the compressed to the original size of samples of the files
+    content.
+    """
+    original = compressed = 0
+    for path in paths:
+        with open(path, 'rb') as fp:
+            sample = fp.read(COMPRESSIBILITY_SAMPLE)
+        original += len(sample)
+        compressed += len(zlib.compress(sample, 1))
+    return float(compressed) / original if original else 1.
+
+
+def _transfer_options(target, paths, transfer, bwlimit=None):
+    """ Returns the rsync options of a transfer of files to a target, adapted to the link
+    with the target and to the compressibility of the files.
+
+    Compression is used on links slow enough for it to be worth the CPU, with a level
+    increasing as the throughput decreases. Slow links are used up to a share of their
+    throughput, unless a bandwidth limit is given.
+
+    :param int bwlimit: bandwidth limit (in KiB/s), 0 for none, None for automatic
+    """
+    if not target.host:
+        return ''
+
+    stats = _link_stats(target)
+    rtt, throughput = stats['rtt'], stats['throughput']
+    if throughput:
+        level = next(level for minimum, level in COMPRESSION_LEVELS if throughput >= minimum)
+    elif rtt is not None and rtt < LAN_MAX_RTT:
+        level = None
+    else:
+        level = DEFAULT_COMPRESSION_LEVEL
+    if level and _compressibility(paths) > INCOMPRESSIBLE_RATIO:
+        level = None
+    if bwlimit is None and throughput and throughput < BWLIMIT_MAX_THROUGHPUT:
+        bwlimit = max(int(throughput * BWLIMIT_SHARE / 1024), 1)
+
+    transfer.info('link : RTT %s, throughput %s -> compression %s, bandwidth limit %s' % (
+        '%.0fms' % (rtt * 1000) if rtt is not None else 'n/a',
+        '%.0fKiB/s' % (throughput / 1024) if throughput else 'n/a',
+        'level %d' % level if level else 'off',
+        '%dKiB/s' % bwlimit if bwlimit else 'none'
+    ))
+    options = []
+    if level:
+        options.append('-z --compress-level=%d' % level)
+    if bwlimit:
+        options.append('--bwlimit=%d' % bwlimit)
+    return ' '.join(options)
+
+
+def _send_files(target, transfer, paths, relay=None, retries=0, options=''):
+    """ Sends a list of files to the target in a single transfer.
+
+    If a relay target is given, the files are sent by the relay, from its deployment
+    directory where they must have been uploaded before. The SSH agent is forwarded to
+    the relay, so that it can connect to the target with our credentials.
+
+    Interrupted transfers are retried up to retries times, with an exponential backoff.
+    Each retry resumes the partially uploaded files, rsync checking the blocks already
+    sent and the whole files once completed.
+
+    The throughput of direct transfers to remote targets, computed from the rsync
+    statistics, is recorded in the link statistics of the target.
+
+    :param str options: additional rsync options of direct transfers
+    :raises subprocess.CalledProcessError: if the transfer fails
+    """
+    # the throughput is measured on direct transfers to remote targets
+    measured = relay is None and target.host
+    if relay is None:
+        command = "rsync %s %s %s %s --no-relative --files-from=- / %s" % (
+            RSYNC_UPLOAD_OPTIONS, '--stats' if measured else '', options, target.ssh.rsync_option,
+            target.deploy_path
+        )
+        file_list = ''.join(os.path.abspath(path) + '\n' for path in paths)
+    else:
+        command = "cd %s && rsync %s --files-from=- . %s" % (
+            pipes.quote(relay.remote_dir if relay.host else relay.deploy_path),
+            RSYNC_UPLOAD_OPTIONS, pipes.quote(target.deploy_path)
+        )
+        if relay.host:
+            command = "%s -A %s %s" % (relay.ssh.ssh_command, relay.host, pipes.quote(command))
+        file_list = ''.join(os.path.basename(path) + '\n' for path in paths)
+
+    delay = TRANSFER_RETRY_DELAY
+    for attempt in range(retries + 1):
+        try:
+            started = time.time()
+            output = transfer.run(command, input=file_list)
+            if measured:
+                _record_throughput(target, output, time.time() - started)
+            return
+        except subprocess.CalledProcessError as e:
+            if attempt == retries or e.returncode not in RSYNC_RETRYABLE_CODES:
+                raise
+            transfer.warn('transfer interrupted (rsync error %d), resuming in %ds...' % (e.returncode, delay))
+            time.sleep(delay)
+            delay *= 2
+
+
+def _send_packages(target, transfer, reports, paths, relay=None, retries=0, options=''):
+    """ Sends the files of packages in a single transfer (see :py:func:`_send_files`).
+
+    If the transfer fails because of a package, the files are then sent one at a time, so
+    that a package which cannot be sent does not prevent the other ones from being
+    deployed. If it is still interrupted once the retries are exhausted, the link with the
+    target is considered as down and no other transfer is attempted. The reports of the
+    packages which could not be sent are marked as failed.
+
+    :param dict paths: the paths of the files to be sent, keyed by package name
+    """
+    try:
+        _send_files(
+            target, transfer, [paths[r.package] for r in reports], relay=relay, retries=retries, options=options
+        )
+        return
+    except subprocess.CalledProcessError as e:
+        transfer.error(e)
+        link_down = e.returncode in RSYNC_RETRYABLE_CODES
+        if len(reports) > 1 and not link_down:
+            transfer.warn('sending the packages one at a time')
+
+    for report in reports:
+        if len(reports) > 1 and not link_down:
+            try:
+                _send_files(
+                    target, transfer, [paths[report.package]], relay=relay, retries=retries, options=options
+                )
+                continue
+            except subprocess.CalledProcessError as e:
+                transfer.error(e)
+                link_down = e.returncode in RSYNC_RETRYABLE_CODES
+        report.failed = True
+        report.error('upload failed' + (' (link down)' if link_down else ''))
+
+
+def _make_deltas(target, changed, statuses, work_dir, transfer):
+    """ Computes the binary deltas between the package files and the previously deployed
+    ones, kept in the target mirror.
+
+    Returns the dictionary of the (delta path, base file name) of the packages for which
+    a delta significantly smaller than the package file could be produced.
+    """
+    deltas = {}
+    for report in changed:
+        status = statuses[report.package]
+        if not (status and status['file']):
+            continue
+        base = os.path.join(target.mirror_pkg, status['file'])
+        if not os.path.exists(base):
+            continue
+
+        delta = os.path.join(work_dir, os.path.basename(report.package_file) + '.xd3')
+        process = subprocess.Popen(
+            ['xdelta3', '-e', '-9', '-f', '-s', base, report.package_file, delta],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT
         )
+        output, _ = process.communicate()
+        if process.returncode:
+            transfer.warn('cannot compute the delta of %s (%s)' % (report.package, output.strip()))
+        elif os.path.getsize(delta) < DELTA_MAX_RATIO * os.path.getsize(report.package_file):
+            deltas[report.package] = (delta, status['file'])
+    return deltas
+
+
+def _apply_deltas(target, changed, deltas, digests, transfer):
+    """ Rebuilds on the target the package files from the uploaded deltas, checking their
+    digests, and returns the set of the packages successfully rebuilt.
+    """
+    script = ['cd %s || exit 1' % pipes.quote(target.remote_dir)]
+    for report in changed:
+        if report.package not in deltas:
+            continue
+        delta, base = deltas[report.package]
+        new, delta = pipes.quote(os.path.basename(report.package_file)), pipes.quote(os.path.basename(delta))
+        script.append(
+            'if xdelta3 -d -f -s %(base)s %(delta)s %(new)s.part '
+            '&& [ "$(sha1sum < %(new)s.part | cut -c1-40)" = %(digest)s ] ; '
+            'then mv -f %(new)s.part %(new)s && echo OK %(package)s ; '
+            'else rm -f %(new)s.part ; echo FAILED %(package)s ; fi ; '
+            'rm -f %(delta)s' % {
+                'base': pipes.quote(base), 'delta': delta, 'new': new,
+                'digest': digests[report.package], 'package': pipes.quote(report.package)
+            }
+        )
+
+    process = subprocess.Popen(
+        "%s %s sh" % (target.ssh.ssh_command, target.host),
+        shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+    )
+    output, _ = process.communicate('\n'.join(script) + '\n')
+    applied = set(line.split(' ', 1)[1] for line in output.splitlines() if line.startswith('OK '))
+    if len(applied) < len(deltas) and process.returncode:
+        transfer.warn('deltas rebuild failed (%s)' % output.strip())
+    return applied
+
+
+def _upload_packages(target, reports, delta=False, relay=None, retries=0, bwlimit=None):
+    """ Uploads in a single transfer the package files of the reports which have changed
+    since their last deployment, and updates their deployment status.
+
+    In delta mode, only the binary deltas against the previously deployed versions are
+    uploaded for remote targets, the package files being rebuilt and checked on the
+    target. Packages for which this fails are then uploaded in full.
+
+    If a relay target is given, the package files are forwarded by the relay (see
+    :py:func:`_send_files`) and the relay is recorded in the deployment status. Deltas
+    are not used in this case.
+
+    Interrupted transfers are resumed up to retries times before the packages are
+    reported as failed.
+
+    Compression and bandwidth limit of direct transfers are adapted to the link with the
+    target (see :py:func:`_transfer_options`), bwlimit overriding the automatic limit.
+    Forwarding by a relay is supposed to be done over a local network, and thus uses
+    neither of them.
+
+    Returns the report of the transfer, or None if no package needed to be uploaded.
+    """
+    changed = []
+    digests = {}
+    statuses = {}
+    for report in reports:
+        statuses[report.package] = status = _db.deployed(target.name, report.package)
+        digests[report.package] = digest = manifest.file_digest(report.package_file)
+        if _is_deployed(status, report.package_file, digest):
+            report.success('no change since last deployed')
+        else:
+            changed.append(report)
+
+    if not changed:
+        return None
 
-        subprocess.check_call("touch %s" % status_file, shell=True)
-        subprocess.check_call(
-            "cp -a %s %s" % (package_file, os.path.join(target_root, TARGET_MIRROR_PKG)),
-            shell=True
+    transfer = PackageReport(
+        None, title="upload of %d package(s) to %s" % (len(changed), target.name) + (
+            " via %s" % relay.name if relay else ""
         )
+    )
+    transfer.info('deploying distribution packages : %s...' % ', '.join(r.package for r in changed))
+
+    deltas = {}
+    work_dir = None
+    if delta and target.host and not relay:
+        if find_executable('xdelta3'):
+            work_dir = tempfile.mkdtemp(prefix='cbx-delta-')
+            deltas = _make_deltas(target, changed, statuses, work_dir, transfer)
+        else:
+            transfer.warn('xdelta3 not found, sending full packages')
 
-        CTerm.success('done')
+    try:
+        paths = dict(
+            (r.package, deltas[r.package][0] if r.package in deltas else r.package_file) for r in changed
+        )
+        options = '' if relay else _transfer_options(target, paths.values(), transfer, bwlimit)
+        _send_packages(target, transfer, changed, paths, relay=relay, retries=retries, options=options)
+
+        if deltas:
+            sent = [r for r in changed if not r.failed]
+            applied = _apply_deltas(target, sent, deltas, digests, transfer)
+            fallback = [r for r in sent if r.package in deltas and r.package not in applied]
+            if fallback:
+                transfer.warn('delta rebuild failed for : %s, sending full packages' % (
+                    ', '.join(r.package for r in fallback)
+                ))
+                _send_packages(target, transfer, fallback, dict(
+                    (r.package, r.package_file) for r in fallback
+                ), retries=retries, options=options)
+            for report in sent:
+                if report.package in applied:
+                    report.info('sent as a delta of %d bytes instead of %d' % (
+                        os.path.getsize(deltas[report.package][0]), os.path.getsize(report.package_file)
+                    ))
+
+    finally:
+        if work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    for report in changed:
+        if report.failed:
+            continue
+        try:
+            _db.record_deployment(
+                target.name, report.package, digests[report.package],
+                _package_version(report.package_file), os.path.basename(report.package_file),
+                via=relay.name if relay else None
+            )
+            shutil.copy2(report.package_file, target.mirror_pkg)
+        except (IOError, OSError, sqlite3.Error) as e:
+            report.failed = True
+            report.error('uploaded, but status update failed (%s)' % e)
+        else:
+            report.deployed = True
+            report.success('done')
 
-    else:
-        CTerm.success('no change since last deployed')
+    return transfer
 
 
 def do_list_packages(args):
@@ -214,13 +1053,13 @@ def do_targets(args):
 
 def do_create_target(args):
     CTerm.banner('initializing...')
-    root_subdir = os.path.join(TARGETS_ROOT, args.target_name)
-    if not os.path.exists(root_subdir):
-        os.mkdir(root_subdir)
-        for d in (TARGET_STATUS_SUBDIR, TARGET_MIRROR_CFG, TARGET_MIRROR_PKG):
-            os.makedirs(os.path.join(root_subdir, d))
-        with file(os.path.join(root_subdir, DEPLOY_PATH_STORE), 'wt') as f:
-            f.write(args.deploy_path)
+    if args.target_name not in _directory:
+        root_subdir = os.path.join(TARGETS_ROOT, args.target_name)
+        for d in (TARGET_MIRROR_CFG, TARGET_MIRROR_PKG):
+            path = os.path.join(root_subdir, d)
+            if not os.path.exists(path):
+                os.makedirs(path)
+        _db.add_target(args.target_name, args.deploy_path)
         CTerm.success('target context created.')
         _update_directory()
 
@@ -229,30 +1068,147 @@ def do_create_target(args):
 
 
 def do_clean(args):
+    _check_current_target()
     CTerm.header('cleaning statuses...')
-    path = os.path.join(TARGETS_ROOT, _current_target, TARGET_STATUS_SUBDIR)
-    for f in os.listdir(path):
-        os.remove(os.path.join(path, f))
+    _db.clear(_current_target)
     CTerm.success('status cleared')
 
 
+def _query_installed(deploy_path, timeout):
+    """ Returns the versions of the CSTBox packages installed on a remote target, as a
+    dictionary keyed by package name (without the 'cstbox-' prefix).
+
+    :raises ValueError: if the target is not a remote one
+    :raises Exception: if the query fails or does not complete within timeout seconds
+    """
+    host = sshmux.remote_host(deploy_path)
+    if not host:
+        raise ValueError('not a remote target')
+
+    process = subprocess.Popen(
+        [
+            'ssh', '-o', 'BatchMode=yes', '-o', 'ConnectTimeout=%d' % timeout, host,
+            "dpkg-query -W -f='${Package}\\t${Version}\\n' 'cstbox-*'"
+        ],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        # own process group, so that children (e.g. proxy commands) are killed too
+        preexec_fn=os.setsid
+    )
+    timer = threading.Timer(timeout, os.killpg, (process.pid, signal.SIGKILL))
+    timer.start()
+    try:
+        output, errors = process.communicate()
+    finally:
+        timer.cancel()
+
+    if process.returncode < 0:
+        raise Exception('no reply within %ds' % timeout)
+    # dpkg-query exits with 1 when some pattern matches no package
+    if process.returncode not in (0, 1) or (process.returncode and not output):
+        raise Exception(errors.strip().splitlines()[-1] if errors.strip() else 'ssh error %d' % process.returncode)
+
+    installed = {}
+    for line in output.splitlines():
+        package, _, version = line.partition('\t')
+        if package.startswith('cstbox-') and version:
+            installed[package[len('cstbox-'):]] = version
+    return installed
+
+
+def _local_version(package):
+    """ Returns the version of the current distribution package of a package, or None if
+    it has not been built.
+    """
+    package_link = os.path.join(CBX_GIT, package, "cstbox-%s.deb" % package)
+    try:
+        return _package_version(os.readlink(package_link))
+    except OSError:
+        return None
+
+
+def _display_fleet_status(args):
+    """ Displays the matrix of the package versions installed on all the targets.
+    """
+    CTerm.header("Installed versions on all targets")
+    if not _targets:
+        CTerm.warn('no target defined')
+        return
+
+    def query(target):
+        try:
+            return target, _query_installed(_directory[target], args.timeout), None
+        except Exception as e: #pylint: disable=W0703
+            return target, None, str(e)
+
+    pool = ThreadPool(min(len(_targets), MAX_CONCURRENT_QUERIES))
+    try:
+        results = dict((target, (installed, error)) for target, installed, error in pool.map(query, _targets))
+    finally:
+        pool.close()
+        pool.join()
+
+    local_versions = dict((package, _local_version(package)) for package in _packages)
+    width = max([12] + [len(t) for t in _targets])
+    CELL = "%" + str(width) + "s"
+
+    CTerm.out(
+        "%30s %12s " % ("Package", "Local") + ' '.join(CELL % t for t in _targets), CTerm.WHITE
+    )
+    CTerm.out('-'*30 + ' ' + '-'*12 + (' ' + '-'*width) * len(_targets), CTerm.WHITE)
+    for package in sorted(_packages):
+        local_version = local_versions[package]
+        cells = []
+        for target in _targets:
+            installed, error = results[target]
+            if installed is None:
+                cells.append(CTerm.YELLOW + CELL % '?')
+                continue
+            version = installed.get(package)
+            if version is None:
+                color = CTerm.BLUE
+            elif version == local_version:
+                color = CTerm.GREEN
+            else:
+                color = CTerm.RED
+            cells.append(color + CELL % (version or '-'))
+        print(CTerm.WHITE + "%30s %12s " % (package, local_version or 'n/a') + ' '.join(cells) + CTerm.RESET)
+
+    for target in _targets:
+        error = results[target][1]
+        if error:
+            CTerm.warn('%s : %s' % (target, error))
+
+
 def do_status(args):
+    if args.all_targets:
+        _display_fleet_status(args)
+        return
+
+    _check_current_target()
     print(
         CTerm.BLUE + 'Current target : ' +
         CTerm.RESET + _current_target +
         CTerm.BLUE + ' -> ' + CTerm.GREEN + CBX_DEPLOY_PATH +
         CTerm.RESET
     )
+    link = _db.link_stats(_current_target)
+    if link:
+        print(
+            CTerm.BLUE + 'Link : ' + CTerm.RESET + 'RTT %s, throughput %s (updated %s)' % (
+                '%.0fms' % (link['rtt'] * 1000) if link['rtt'] is not None else 'n/a',
+                '%.0fKiB/s' % (link['throughput'] / 1024) if link['throughput'] else 'n/a',
+                time.ctime(link['updated'])
+            )
+        )
 
-    STATUS_FORMAT = CTerm.WHITE + "%30s %s%24s %s%24s" + CTerm.RESET
-    HEADER_SEP = '-'*30 + ' ' + '-'*24 + ' ' + '-'*24
-    HEADER_FORMAT = "%30s %24s %24s"
+    STATUS_FORMAT = CTerm.WHITE + "%30s %s%24s %s%16s %24s %s" + CTerm.RESET
+    HEADER_SEP = '-'*30 + ' ' + '-'*24 + ' ' + '-'*16 + ' ' + '-'*24 + ' ' + '-'*10
+    HEADER_FORMAT = "%30s %24s %16s %24s %s"
     try:
-        CTerm.out(HEADER_FORMAT % ("Package", "Last updated", "Last deployed"), CTerm.WHITE)
+        CTerm.out(HEADER_FORMAT % ("Package", "Last updated", "Deployed version", "Last deployed", "Via"), CTerm.WHITE)
         CTerm.out(HEADER_SEP, CTerm.WHITE)
-        status_dir = os.path.join(TARGETS_ROOT, _current_target, TARGET_STATUS_SUBDIR)
-        for name in sorted((fname for fname in os.listdir(status_dir) if fname != DEPLOY_PATH_STORE)):
-            last_deployed = os.path.getmtime(os.path.join(status_dir, name))
+        for status in _db.deployed_packages(_current_target):
+            name = status['package']
 
             pkg_link = os.path.join(CBX_GIT, name, "cstbox-%s.deb" % name)
             if not os.path.exists(pkg_link):
@@ -260,9 +1216,9 @@ def do_status(args):
                 pkg_col = CTerm.RED
                 deploy_col = CTerm.BLUE
             else:
-                pkg_file = os.readlink(pkg_link)
-                pkg_version = os.path.getmtime(os.path.join(os.path.dirname(pkg_link), pkg_file))
-                if pkg_version <= last_deployed:
+                pkg_file = os.path.join(os.path.dirname(pkg_link), os.readlink(pkg_link))
+                pkg_version = os.path.getmtime(pkg_file)
+                if _is_deployed(status, pkg_file, manifest.file_digest(pkg_file)):
                     pkg_col = CTerm.BLUE
                     deploy_col = CTerm.GREEN
                 else:
@@ -271,13 +1227,30 @@ def do_status(args):
             print(STATUS_FORMAT % (
                 name,
                 pkg_col,
-                time.ctime(pkg_version) if pkg_version else 'n/a', deploy_col, time.ctime(last_deployed)
+                time.ctime(pkg_version) if pkg_version else 'n/a', deploy_col,
+                status.get('version') or 'n/a', time.ctime(status['deployed']),
+                status.get('via') or '-'
             ))
 
     except OSError as err:
         CTerm.warn("no status available (%s)" % err)
 
 
+def do_history(args):
+    target = None if args.all_targets else _current_target
+    if not args.all_targets:
+        _check_current_target()
+
+    HISTORY_FORMAT = "%24s %20s %30s %16s %12s %s"
+    CTerm.out(HISTORY_FORMAT % ("Deployed", "Target", "Package", "Version", "Digest", "Via"), CTerm.WHITE)
+    CTerm.out('-'*24 + ' ' + '-'*20 + ' ' + '-'*30 + ' ' + '-'*16 + ' ' + '-'*12 + ' ' + '-'*10, CTerm.WHITE)
+    for entry in _db.history(target=target, package=args.package, limit=args.limit):
+        print(HISTORY_FORMAT % (
+            time.ctime(entry['deployed']), entry['target'], entry['package'],
+            entry['version'] or 'n/a', (entry['digest'] or 'n/a')[:12], entry['via'] or '-'
+        ))
+
+
 def li(s, hi=False):
     CTerm.out('  - ' + s, with_color=CTerm.HIWHITE if hi else CTerm.GREEN)
 
@@ -292,6 +1265,20 @@ def do_info(args):
         li(pname)
 
 
+def _remote_manifests(target, areas):
+    """ Returns the manifests of the (name, directory) areas of a target, obtained in a
+    single round trip.
+    """
+    process = subprocess.Popen(
+        "%s %s sh" % (target.ssh.ssh_command, target.host) if target.host else "sh",
+        shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    output, errors = process.communicate(manifest.remote_script(areas, excluded=(PARTIAL_DIR,)))
+    if process.returncode:
+        raise Exception("cannot get the files manifest of the target (%s)" % errors.strip())
+    return manifest.parse_remote(output)
+
+
 def do_mirror(args):
     CTerm.header("Retrieving target version of files...")
     if not any((args.mirror_all, args.mirror_pkg, args.mirror_cfg)):
@@ -299,31 +1286,85 @@ def do_mirror(args):
     elif args.mirror_all:
         args.mirror_pkg = args.mirror_cfg = True
 
-    target_root = os.path.join(TARGETS_ROOT, _current_target)
-
-    if args.mirror_pkg:
-        CTerm.banner('packages')
-        src = os.path.join(CBX_DEPLOY_PATH, '*')
-        dst = os.path.join(target_root, TARGET_MIRROR_PKG)
+    with _get_target() as target:
+        if sshmux.is_daemon_path(target.deploy_path):
+            # the manifests of the files are computed by a shell script run on the target
+            raise ValueError('rsync daemon targets cannot be mirrored (%s)' % target.deploy_path)
+
+        # (name, remote directory, local directory)
+        areas = []
+        if args.mirror_pkg:
+            areas.append(('packages', target.remote_dir if target.host else target.deploy_path, target.mirror_pkg))
+        if args.mirror_cfg:
+            if target.host:
+                areas.append(('configuration files', '/etc/cstbox', os.path.join(target.mirror_cfg, 'cstbox')))
+            else:
+                CTerm.error('configuration files cannot be mirrored for local targets')
+        if not areas:
+            return
+
+        remote_manifests = _remote_manifests(target, [(name, remote_dir) for name, remote_dir, _ in areas])
+        cache_path = os.path.join(target.root, MIRROR_MANIFEST_CACHE)
+        caches = manifest.load_cache(cache_path)
+        for name, _, _ in areas:
+            caches.setdefault(name, {})
+
+        def mirror(area):
+            name, remote_dir, local_dir = area
+            report = PackageReport(None, title=name)
+            remote_manifest = remote_manifests.get(name)
+            if remote_manifest is None:
+                report.failed = True
+                report.error('%s not found on the target' % remote_dir)
+                return report
+
+            new, changed, removed = manifest.diff(remote_manifest, manifest.scan(local_dir, caches[name]))
+            for path in new:
+                report.info('+ ' + path)
+            for path in changed:
+                report.info('M ' + path)
+            for path in removed:
+                report.warn('- %s (not on the target)' % path)
+            if not (new or changed):
+                report.success('mirror is up to date')
+                return report
+            if args.diff:
+                report.success('%d new, %d changed' % (len(new), len(changed)))
+                return report
+
+            src = (target.host + ':' if target.host else '') + os.path.join(remote_dir, '')
+            try:
+                # changed files can have the same size and modification time as their
+                # mirrored version, and are thus compared by content
+                report.run(
+                    "rsync -av --checksum %s --files-from=- %s %s" % (
+                        target.ssh.rsync_option, pipes.quote(src), pipes.quote(os.path.join(local_dir, ''))
+                    ),
+                    input=''.join(path + '\n' for path in new + changed)
+                )
+                manifest.scan(local_dir, caches[name])
+            except (subprocess.CalledProcessError, OSError, IOError) as e:
+                report.failed = True
+                report.error(e)
+            else:
+                report.success('%d file(s) retrieved' % (len(new) + len(changed)))
+            return report
 
-        subprocess.check_call(
-            "rsync -av %s %s" % (src, dst),
-            shell=True
-        )
+        pool = ThreadPool(len(areas))
+        try:
+            reports = pool.map(mirror, areas)
+        finally:
+            pool.close()
+            pool.join()
 
-    if args.mirror_cfg:
-        CTerm.banner('configuration files')
-        if ':' in CBX_DEPLOY_PATH:
-            host, _ = CBX_DEPLOY_PATH.split(':')
-            src = host + ':/etc/cstbox'
-            dst = os.path.join(target_root, TARGET_MIRROR_CFG)
-            subprocess.check_call(
-                "rsync -arv %s %s" % (src, dst),
-                shell=True
-            )
+        for report in reports:
+            report.display()
+        if not args.diff:
+            manifest.save_cache(cache_path, caches)
 
-        else:
-            CTerm.error('cannot be done for local targets')
+        failures = [report.title for report in reports if report.failed]
+        if failures:
+            raise Exception("mirroring failed for : %s" % ', '.join(failures))
 
 
 if __name__ == '__main__':
@@ -353,9 +1394,20 @@ if __name__ == '__main__':
         )
         sys.exit(1)
 
-    else:
+    try:
+        if not os.path.exists(TARGETS_ROOT):
+            os.mkdir(TARGETS_ROOT)
+
+        _db = deploydb.DeployDB(os.path.join(TARGETS_ROOT, deploydb.DEFAULT_DB_NAME))
+        # targets created by previous versions are stored as directories
+        for _name in _db.import_legacy(TARGETS_ROOT, DEPLOY_PATH_STORE, TARGET_STATUS_SUBDIR):
+            CTerm.info("target '%s' imported in the deployment database" % _name)
         _update_directory()
 
+    except Exception as e: #pylint: disable=W0703
+        CTerm.error("cannot open the deployment database (%s)" % e)
+        sys.exit(1)
+
     parser = argparse.ArgumentParser(
         description="CSTBox application optimized deployment tool."
     )
@@ -370,25 +1422,103 @@ if __name__ == '__main__':
         else:
             raise argparse.ArgumentTypeError()
 
+    def _positive_int_type(s):
+        try:
+            n = int(s)
+            if n > 0:
+                return n
+        except ValueError:
+            pass
+        raise argparse.ArgumentTypeError('invalid positive integer (%s)' % s)
+
+    def _non_negative_int_type(s):
+        try:
+            n = int(s)
+            if n >= 0:
+                return n
+        except ValueError:
+            pass
+        raise argparse.ArgumentTypeError('invalid non negative integer (%s)' % s)
+
+    # options shared by the deployment commands
+    deploy_opts = {
+        '--targets': {
+            'help': "comma separated list of the targets to deploy to, instead of the current one",
+            'metavar': 'TARGET,...'
+        },
+        '--all-targets': {
+            'help': "deploys to all the known targets",
+            'dest': 'all_targets',
+            'action': 'store_true'
+        },
+        '--relay': {
+            'help': "uploads the packages to this target only, which forwards them to the other ones",
+            'metavar': 'TARGET'
+        },
+        '--retries': {
+            'help': "number of times interrupted transfers are resumed before giving up (default: %d)" %
+                    DEFAULT_TRANSFER_RETRIES,
+            'metavar': 'N',
+            'type': _non_negative_int_type,
+            'default': DEFAULT_TRANSFER_RETRIES
+        },
+        '--bwlimit': {
+            'help': "bandwidth limit (in KiB/s) of the uploads, 0 for none "
+                    "(default: adapted to the throughput of each target link)",
+            'metavar': 'KBPS',
+            'type': _non_negative_int_type
+        },
+        '--order': {
+            'help': "sends the packages one at a time, smallest first or by priority "
+                    "(i.e. in the order of the packages configuration)",
+            'choices': ('smallest', 'priority')
+        },
+        '--max-targets': {
+            'help': "maximum number of targets receiving packages at the same time",
+            'dest': 'max_targets',
+            'metavar': 'N',
+            'type': _positive_int_type,
+            'default': DEFAULT_MAX_TARGETS
+        },
+        '-d': {
+            'help': "sends binary deltas against the previously deployed packages (requires xdelta3)",
+            'dest': 'delta',
+            'action': 'store_true'
+        }
+    }
+
+    def _with_deploy_opts(opts):
+        merged = dict(deploy_opts)
+        merged.update(opts)
+        return merged
+
     commands = {
         'all': (
             {
                 'help': 'deploys all packages of the configuration'
             },
-            None,
+            _with_deploy_opts({
+                '-j': {
+                    'help': "number of packages built concurrently",
+                    'dest': 'jobs',
+                    'metavar': 'N',
+                    'type': _positive_int_type,
+                    'default': 1
+                }
+            }),
             do_all
         ),
         'package': (
             {
                 'help': 'deploys a single package'
             },
-            {
+            _with_deploy_opts({
                 'package': {
                     'metavar': 'PACKAGE_NAME',
                     'choices': _packages,
                     'help': 'name of the package to be deployed'
                 }
-            },
+            }),
             do_package
         ),
         'packages': (
@@ -433,9 +1563,46 @@ if __name__ == '__main__':
             {
                 'help': "displays the deployment status of the current target"
             },
-            None,
+            {
+                '--all': {
+                    'help': "displays the package versions installed on all the targets",
+                    'dest': 'all_targets',
+                    'action': 'store_true'
+                },
+                '--timeout': {
+                    'help': "per target query timeout (in seconds) for --all",
+                    'metavar': 'SECONDS',
+                    'type': _positive_int_type,
+                    'default': DEFAULT_QUERY_TIMEOUT
+                }
+            },
             do_status
         ),
+        'history': (
+            {
+                'help': "displays the deployment history of the current target"
+            },
+            {
+                '-p': {
+                    'help': "displays only the deployments of this package",
+                    'dest': 'package',
+                    'metavar': 'PACKAGE_NAME'
+                },
+                '-A': {
+                    'help': "displays the deployments on all targets",
+                    'dest': 'all_targets',
+                    'action': 'store_true'
+                },
+                '-n': {
+                    'help': "maximum number of deployments displayed",
+                    'dest': 'limit',
+                    'metavar': 'N',
+                    'type': _positive_int_type,
+                    'default': 50
+                }
+            },
+            do_history
+        ),
         'info': (
             {
                 'help': "displays information about the context"
@@ -462,6 +1629,10 @@ if __name__ == '__main__':
                     'help': "mirror all (same as -c -p)",
                     'dest': 'mirror_all',
                     'action': 'store_true'
+                },
+                '--diff': {
+                    'help': "only reports the files which differ, without retrieving them",
+                    'action': 'store_true'
                 }
             },
             do_mirror
@@ -482,9 +1653,6 @@ if __name__ == '__main__':
     _args = parser.parse_args()
 
     try:
-        if not os.path.exists(TARGETS_ROOT):
-            os.mkdir(TARGETS_ROOT)
-
         _args.handler(_args)
     except Exception as e: #pylint: disable=W0703
         CTerm.error(e)
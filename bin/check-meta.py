@@ -2,6 +2,34 @@
 # -*- coding: utf-8 -*-
 
 """ Device meta data checking tool.
+
+Checks all the files designated by the arguments, which can be files, directories
+(scanned recursively) or glob patterns, in a single process or using a pool of workers.
+Errors are reported as 'path:line:column: message', and the exit status is 0 if all
+files are valid, 1 if some are not.
+
+Besides the JSON syntax, the structure of the meta data is validated against a schema
+(lib/devcfg-meta.schema.json by default). It uses a subset of the JSON Schema language :
+type, enum, properties, required, patternProperties, additionalProperties, items,
+minimum, maximum, minLength, maxLength and local references ("#/definitions/..."). The
+schema is compiled once into a tree of validation functions, which is then applied to
+all the checked files.
+
+Valid files are recorded in a cache (.check-meta.cache by default) with their size,
+modification time and content digest, together with the validator version. Files found
+unchanged since their last successful check are not checked again : this costs a stat if
+size and modification time are the same, and a digest computation otherwise. --force
+ignores the cache content.
+
+With --bundle, the meta data of a devcfg.d tree are merged into a single JSON file, so
+that they can be loaded with one read instead of opening and parsing every file. The
+bundle contains the meta data of each device type (made of the path of its file relative
+to the tree root, directories '.d' suffix being removed and path separators replaced by
+':', e.g. 'modbus:rhf3201') and the digest of the tree content. It is written only if
+all the files are valid.
+
+Hidden files and 'attic' directories (holding deprecated stuff) are ignored when scanning
+directories, as they are when packaging the devcfg.d tree (see lib/makefile-dist.mk).
 """
 
 import sys
@@ -9,29 +37,470 @@ import argparse
 import os
 import json
 import pprint
+import re
+import glob
+import multiprocessing
+import hashlib
+import numbers
 
 __author__ = 'Eric PASCUAL - CSTB (eric.pascual@cstb.fr)'
 __copyright__ = 'Copyright (c) 2013 CSTB'
 __vcs_id__ = '$Id$'
-__version__ = '1.0.0'
+__version__ = '1.3.0'
+
+DEFAULT_CACHE_PATH = '.check-meta.cache'
+# name of the directories holding deprecated stuff, not packaged
+ATTIC_DIR = 'attic'
+BUNDLE_FORMAT = 1
+DEFAULT_SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib', 'devcfg-meta.schema.json')
+
+# the compiled schema validator used by this process
+_validator = None
+
+_ERROR_POSITION = re.compile(r'line (\d+) column (\d+)')
+
+
+class CheckError(object):
+    """ An error found in a checked file.
+    """
+    def __init__(self, path, message, line=0, column=0):
+        self.path = path
+        self.message = message
+        self.line = line
+        self.column = column
+
+    def __unicode__(self):
+        return u'%s:%d:%d: %s' % (_text(self.path), self.line, self.column, _text(self.message))
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+
+def _text(s):
+    return s.decode('utf-8', 'replace') if isinstance(s, str) else s
+
+
+def _json_error(path, e):
+    line = getattr(e, 'lineno', None)
+    column = getattr(e, 'colno', None)
+    if line is None:
+        m = _ERROR_POSITION.search(str(e))
+        if m:
+            line, column = int(m.group(1)), int(m.group(2))
+        else:
+            line = column = 0
+    return CheckError(path, getattr(e, 'msg', None) or str(e).split(':')[0], line, column)
+
+
+class SchemaError(Exception):
+    pass
+
+
+_STRING_TYPES = (str, type(u''))
+
+_TYPE_CHECKS = {
+    'object': lambda v: isinstance(v, dict),
+    'array': lambda v: isinstance(v, list),
+    'string': lambda v: isinstance(v, _STRING_TYPES),
+    'integer': lambda v: isinstance(v, numbers.Integral) and not isinstance(v, bool),
+    'number': lambda v: isinstance(v, numbers.Real) and not isinstance(v, bool),
+    'boolean': lambda v: isinstance(v, bool),
+    'null': lambda v: v is None,
+}
+
+
+def _json_path(path):
+    return u'/' + u'/'.join(unicode(p) for p in path)
+
+
+def compile_schema(schema):
+    """ Compiles a schema into a validation function.
+
+    The returned function is called with the value to be validated, its path (as a tuple
+    of keys and indexes) and the list to which (path, message) errors are appended.
+
+    :raises SchemaError: if the schema is invalid
+    """
+    compiled_refs = {}
+
+    def resolve(ref):
+        if not ref.startswith('#/'):
+            raise SchemaError('unsupported reference : %s' % ref)
+        node = schema
+        for key in ref[2:].split('/'):
+            try:
+                node = node[key]
+            except (KeyError, TypeError):
+                raise SchemaError('unresolved reference : %s' % ref)
+        return node
+
+    def compile_ref(ref):
+        if ref not in compiled_refs:
+            # placeholder allowing recursive definitions
+            compiled_refs[ref] = None
+            compiled_refs[ref] = compile_node(resolve(ref))
+
+        def validate(value, path, errors):
+            compiled_refs[ref](value, path, errors)
+        return validate
+
+    def compile_node(node):
+        if not isinstance(node, dict):
+            raise SchemaError('invalid schema node : %r' % node)
+        if '$ref' in node:
+            return compile_ref(node['$ref'])
+
+        checks = []
+
+        types = node.get('type')
+        if types:
+            types = [types] if isinstance(types, _STRING_TYPES) else types
+            try:
+                type_checks = [_TYPE_CHECKS[t] for t in types]
+            except KeyError as e:
+                raise SchemaError('unknown type : %s' % e)
+            type_names = ' or '.join(types)
+        else:
+            type_checks = None
+
+        if 'enum' in node:
+            choices = node['enum']
+
+            def check_enum(value, path, errors):
+                if value not in choices:
+                    errors.append((path, '%r is not one of %r' % (value, choices)))
+            checks.append(check_enum)
+
+        for keyword, test, message in (
+            ('minimum', lambda v, limit: isinstance(v, numbers.Real) and v < limit, 'less than'),
+            ('maximum', lambda v, limit: isinstance(v, numbers.Real) and v > limit, 'greater than'),
+            ('minLength', lambda v, limit: isinstance(v, _STRING_TYPES) and len(v) < limit, 'shorter than'),
+            ('maxLength', lambda v, limit: isinstance(v, _STRING_TYPES) and len(v) > limit, 'longer than'),
+        ):
+            if keyword in node:
+                def check_limit(value, path, errors, limit=node[keyword], test=test, message=message):
+                    if test(value, limit):
+                        errors.append((path, '%r is %s %r' % (value, message, limit)))
+                checks.append(check_limit)
+
+        properties = dict((k, compile_node(v)) for k, v in node.get('properties', {}).iteritems())
+        patterns = [(re.compile(k), compile_node(v)) for k, v in node.get('patternProperties', {}).iteritems()]
+        required = node.get('required', [])
+        additional = node.get('additionalProperties', True)
+        if isinstance(additional, dict):
+            additional = compile_node(additional)
+
+        if properties or patterns or required or additional is not True:
+            def check_object(value, path, errors):
+                if not isinstance(value, dict):
+                    return
+                for key in required:
+                    if key not in value:
+                        errors.append((path, "missing required key '%s'" % key))
+                for key, item in value.iteritems():
+                    matched = False
+                    if key in properties:
+                        properties[key](item, path + (key,), errors)
+                        matched = True
+                    for pattern, validate in patterns:
+                        if pattern.search(key):
+                            validate(item, path + (key,), errors)
+                            matched = True
+                    if not matched:
+                        if additional is False:
+                            errors.append((path, "unknown key '%s'" % key))
+                        elif additional is not True:
+                            additional(item, path + (key,), errors)
+            checks.append(check_object)
+
+        if 'items' in node:
+            items = compile_node(node['items'])
+
+            def check_items(value, path, errors):
+                if isinstance(value, list):
+                    for i, item in enumerate(value):
+                        items(item, path + (i,), errors)
+            checks.append(check_items)
+
+        def validate(value, path, errors):
+            if type_checks and not any(check(value) for check in type_checks):
+                errors.append((path, 'expected %s, got %s' % (type_names, type(value).__name__)))
+                return
+            for check in checks:
+                check(value, path, errors)
+
+        return validate
+
+    return compile_node(schema)
+
+
+def load_validator(schema_path):
+    """ Loads and compiles a schema file, and returns the validator and its identifier,
+    which changes with the content of the schema and the version of this tool.
+
+    :raises SchemaError: if the schema cannot be loaded or compiled
+    """
+    if not schema_path:
+        return None, __version__
+
+    try:
+        with open(schema_path, 'rb') as fp:
+            content = fp.read()
+        schema = json.loads(content)
+    except (IOError, ValueError) as e:
+        raise SchemaError('cannot load schema %s (%s)' % (schema_path, e))
+
+    return compile_schema(schema), '%s/%s' % (__version__, hashlib.sha1(content).hexdigest())
+
+
+def set_validator(schema_path):
+    """ Sets the validator used by this process.
+
+    Used as the initializer of the pool worker processes.
+    """
+    global _validator
+    _validator, _ = load_validator(schema_path)
+
+
+def _locate(content, path):
+    """ Returns the approximate (line, column) position of a JSON path in a document
+    decoded as unicode, by searching successively the keys of the path.
+    """
+    pos = 0
+    for key in path:
+        if isinstance(key, _STRING_TYPES):
+            found = content.find(u'"%s"' % key, pos)
+            if found < 0:
+                break
+            pos = found
+    return content.count('\n', 0, pos) + 1, pos - content.rfind('\n', 0, pos)
+
+
+def check_file(path, known_digest=None):
+    """ Checks a meta data file and returns the list of errors found, the loaded meta data
+    (None if not valid or not loaded) and the digest of the file content.
+
+    If the digest matches known_digest, the file content is known to be valid and is not
+    checked again.
+    """
+    try:
+        with open(path, 'rb') as infile:
+            content = infile.read()
+    except (IOError, OSError) as e:
+        return [CheckError(path, e.strerror or str(e))], None, None
+
+    digest = hashlib.sha1(content).hexdigest()
+    if digest == known_digest:
+        return [], None, digest
+
+    try:
+        meta = json.loads(content)
+    except ValueError as e:
+        return [_json_error(path, e)], None, digest
+
+    if _validator:
+        schema_errors = []
+        _validator(meta, (), schema_errors)
+        if schema_errors:
+            # the content has been decoded successfully by the JSON parser
+            text = content.decode('utf-8', 'replace')
+            return [
+                CheckError(path, u'%s: %s' % (_json_path(p), message), *_locate(text, p))
+                for p, message in schema_errors
+            ], None, digest
+
+    return [], meta, digest
+
+
+def _check_file_task(task):
+    path, known_digest = task
+    errors, meta, digest = check_file(path, known_digest)
+    return path, errors, meta, digest
+
+
+class CheckCache(object):
+    """ Records of the files found valid, keyed by their path.
+    """
+    def __init__(self, path, validator_id):
+        self._path = path
+        self._validator_id = validator_id
+        try:
+            with open(path, 'rt') as fp:
+                self._entries = json.load(fp)
+        except (IOError, ValueError):
+            self._entries = {}
+
+    def lookup(self, path, st):
+        """ Returns a (unchanged, digest) tuple, unchanged being True if the file is known as
+        valid with the same size and modification time, and digest the one of its last
+        valid content if any.
+        """
+        entry = self._entries.get(path)
+        if not entry or entry['validator'] != self._validator_id:
+            return False, None
+        return (entry['size'], entry['mtime']) == (st.st_size, st.st_mtime), entry['digest']
+
+    def update(self, path, st, digest):
+        self._entries[path] = {
+            'size': st.st_size,
+            'mtime': st.st_mtime,
+            'digest': digest,
+            'validator': self._validator_id
+        }
+
+    def discard(self, path):
+        self._entries.pop(path, None)
+
+    def save(self):
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'wt') as fp:
+            json.dump(self._entries, fp)
+        os.rename(tmp_path, self._path)
+
+
+def expand_paths(specs):
+    """ Returns the sorted list of files designated by a list of files, directories and
+    glob patterns. Hidden files and directories, and attic directories are ignored when
+    scanning directories.
+
+    :raises ValueError: if a specification matches nothing
+    """
+    files = set()
+    for spec in specs:
+        matches = glob.glob(spec) if glob.has_magic(spec) else [spec]
+        if not matches or not all(os.path.exists(p) for p in matches):
+            raise ValueError('path not found (%s)' % spec)
+
+        for match in matches:
+            if os.path.isdir(match):
+                for dir_path, dir_names, file_names in os.walk(match):
+                    dir_names[:] = [d for d in dir_names if not d.startswith('.') and d != ATTIC_DIR]
+                    files.update(os.path.join(dir_path, f) for f in file_names if not f.startswith('.'))
+            else:
+                files.add(match)
+
+    return sorted(files)
+
+
+def device_type(root, path):
+    """ Returns the device type corresponding to a meta data file of a devcfg.d tree.
+    """
+    parts = os.path.relpath(path, root).split(os.sep)
+    return ':'.join([d[:-2] if d.endswith('.d') else d for d in parts[:-1]] + parts[-1:])
+
+
+def write_bundle(bundle_path, root, metas, digests):
+    """ Writes the meta data bundle of a devcfg.d tree.
+
+    :param str bundle_path: path of the bundle file
+    :param str root: root of the tree
+    :param dict metas: the meta data of the tree files, keyed by path
+    :param dict digests: the content digests of the tree files, keyed by path
+    """
+    devices = {}
+    paths = {}
+    tree_digest = hashlib.sha1()
+    for path in sorted(metas):
+        devtype = device_type(root, path)
+        devices[devtype] = metas[path]
+        paths[devtype] = os.path.relpath(path, root)
+        tree_digest.update('%s\0%s\0' % (paths[devtype], digests[path]))
+
+    tmp_path = bundle_path + '.tmp'
+    with open(tmp_path, 'wt') as fp:
+        json.dump({
+            'format': BUNDLE_FORMAT,
+            'digest': tree_digest.hexdigest(),
+            'devices': devices,
+            'paths': paths
+        }, fp, separators=(',', ':'), sort_keys=True)
+    os.rename(tmp_path, bundle_path)
+
 
 def main(args):
-    with file(args.infile, 'rt') as infile:
-        meta = json.load(infile)
-        print("[INFO] meta-data are valid.")
-        if args.verbose:
-            pprint.pprint(meta)
+    if args.bundle and (len(args.paths) != 1 or not os.path.isdir(args.paths[0])):
+        raise ValueError('bundle generation requires a single devcfg.d directory')
+
+    paths = expand_paths(args.paths)
+
+    global _validator
+    _validator, validator_id = load_validator(args.schema)
+
+    cache = CheckCache(args.cache, validator_id) if args.cache else None
+    use_cache = cache and not (args.force or args.verbose)
+
+    stats = {}
+    tasks = []
+    for path in paths:
+        stats[path] = st = os.stat(path)
+        unchanged, digest = cache.lookup(path, st) if use_cache else (False, None)
+        if not unchanged:
+            tasks.append((path, digest))
+
+    if args.jobs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(args.jobs, set_validator, (args.schema,))
+        try:
+            results = pool.map(_check_file_task, tasks, chunksize=max(1, len(tasks) // (args.jobs * 4)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_check_file_task(task) for task in tasks]
+
+    invalid = 0
+    metas = {}
+    digests = {}
+    for path, errors, meta, digest in results:
+        metas[path], digests[path] = meta, digest
+        if errors:
+            invalid += 1
+            for error in errors:
+                print('[ERR] %s' % error)
+            if cache:
+                cache.discard(path)
+        else:
+            if cache:
+                cache.update(path, stats[path], digest)
+            if args.verbose:
+                print('[INFO] %s' % path)
+                pprint.pprint(meta)
+
+    if cache:
+        cache.save()
+    if len(tasks) < len(paths):
+        print("[INFO] %d unchanged file(s) skipped." % (len(paths) - len(tasks)))
+
+    if invalid:
+        print("[ERR] %d file(s) checked, %d invalid." % (len(paths), invalid))
+        return 1
+
+    print("[INFO] %d file(s) checked, meta-data are valid." % len(paths))
+
+    if args.bundle:
+        # files found unchanged thanks to the cache have not been parsed
+        for path in paths:
+            if metas.get(path) is None:
+                with open(path, 'rb') as fp:
+                    content = fp.read()
+                metas[path] = json.loads(content)
+                digests[path] = hashlib.sha1(content).hexdigest()
+        write_bundle(args.bundle, args.paths[0], metas, digests)
+        print("[INFO] bundle written to %s." % args.bundle)
+
+    return 0
 
 
 if __name__ == '__main__':
     _me = sys.modules[__name__]
 
-    def input_file(s):
-        if not os.path.exists(s):
-            raise argparse.ArgumentTypeError('path not found (%s)' % s)
-        if not os.path.isfile(s):
-            raise argparse.ArgumentTypeError('path is not a file (%s)' % s)
-        return s
+    def positive_int(s):
+        try:
+            n = int(s)
+            if n > 0:
+                return n
+        except ValueError:
+            pass
+        raise argparse.ArgumentTypeError('invalid positive integer (%s)' % s)
 
     parser = argparse.ArgumentParser(
         description=_me.__doc__,
@@ -39,25 +508,63 @@ if __name__ == '__main__':
     )
 
     parser.add_argument(
-        'infile',
-        metavar='INFILE',
-        help="file to be checked",
-        type=input_file
+        'paths',
+        metavar='PATH',
+        nargs='+',
+        help="files, directories or glob patterns of the files to be checked"
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        type=positive_int,
+        default=1,
+        help='number of worker processes'
+    )
+    parser.add_argument(
+        '--schema',
+        default=DEFAULT_SCHEMA_PATH,
+        help='path of the meta data schema'
+    )
+    parser.add_argument(
+        '--no-schema',
+        dest='schema',
+        action='store_const',
+        const=None,
+        help='checks only the JSON syntax'
+    )
+    parser.add_argument(
+        '--bundle',
+        metavar='BUNDLE_PATH',
+        help='merges the meta data of the checked devcfg.d tree in this file'
+    )
+    parser.add_argument(
+        '--cache',
+        default=DEFAULT_CACHE_PATH,
+        help='path of the validation cache'
+    )
+    parser.add_argument(
+        '--no-cache',
+        dest='cache',
+        action='store_const',
+        const=None,
+        help='does not use nor update the validation cache'
+    )
+    parser.add_argument(
+        '-f', '--force',
+        action='store_true',
+        default=False,
+        help='checks all files, whatever the cache content'
     )
     parser.add_argument(
         '-v', '--verbose',
         action='store_true',
         default=False,
-        help='verbose outputr'
+        help='verbose output'
     )
 
     _args = parser.parse_args()
 
     try:
-        main(_args)
+        sys.exit(main(_args))
     except Exception as e:
         print('[ERR] %s' % e)
         sys.exit(2)
-    else:
-        sys.exit(0)
-
@@ -10,8 +10,22 @@ import subprocess
 import hashlib
 import binascii
 
+# the libraries are used from the repository if they are not installed (see README.md)
+try:
+    import cstbox_devtools
+except ImportError:
+    sys.path.insert(0, os.path.join(
+        os.environ.get('CSTBOX_DEVEL_HOME') or os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'),
+        'src'
+    ))
+
+from cstbox_devtools import sshmux
+
 PACKAGES = None
 
+# multiplexed SSH connection shared by the transfers to the target
+_ssh = None
+
 STATUS_DIR_ROOT = './status'
 DEPLOY_PATH_STORE = '.deploy_path'
 
@@ -150,7 +164,7 @@ def _do_package(args):
     if last_modified > last_deployed:
         CTerm.info('deploying distribution package...')
         subprocess.check_call(
-            "rsync -Cav %s %s" % (package_file, CBX_DEPLOY_PATH),
+            "rsync -Cav %s %s %s" % (_ssh.rsync_option, package_file, CBX_DEPLOY_PATH),
             shell=True
         )
 
@@ -347,7 +361,8 @@ if __name__ == '__main__':
 
     else:
         try:
-            _args.handler(_args)
+            with sshmux.for_path(CBX_DEPLOY_PATH) as _ssh:
+                _args.handler(_args)
         except Exception as e: #pylint: disable=W0703
             CTerm.error(e)
             sys.exit(1)
@@ -104,6 +104,15 @@ RSYNC=rsync -Ca --prune-empty-dirs -L $(RSYNC_VERBOSE)
 # JSON syntax checking
 json_check = python -c "import json;json.load(file('$(1)'))"
 
+# devices metadata checking (see check_metadata_files)
+CHECK_META?=python $(CSTBOX_DEVEL_HOME)/bin/check-meta.py
+CHECK_META_JOBS?=$(shell nproc 2> /dev/null || echo 1)
+# set to --force to ignore the validation cache (.check-meta.cache)
+CHECK_META_OPTS?=
+DEVCFG_FROM?=$(LIB_FROM)/python/pycstbox/devcfg.d
+# devices metadata bundle, built next to the devcfg.d tree (see build_devices_metadata_bundle)
+DEVCFG_BUNDLE?=devcfg.bundle.json
+
 
 dist: prepare
 	@echo '------ creating Debian package...'
@@ -258,7 +267,8 @@ copy_java_executables: check_java_project_root build_java_executable
 	    --exclude "*" \
 	    $(JAVA_PROJECT_ROOT)/bin/ $(BUILD_DIR)/$(CSTBOX_BINARIES_INSTALL_DIR)
 
-copy_devices_metadata_files:
+# the bundle is built from the same files, validating them before they are packaged
+copy_devices_metadata_files: build_devices_metadata_bundle
 	@echo '------ copying devices metadata files ...'
 	mkdir -p \
 	    $(BUILD_DIR)/$(CSTBOX_PACKAGES_INSTALL_DIR) 
@@ -272,6 +282,16 @@ copy_devices_metadata_files:
 	    --include "devcfg.d/*" \
 	    $(LIB_FROM)/python/pycstbox $(BUILD_DIR)/$(CSTBOX_PACKAGES_INSTALL_DIR)
 
+build_devices_metadata_bundle:
+# Merges the validated metadata files in a single one indexed by device type, so that
+# they can be loaded at once on the target instead of being parsed one by one.
+	@echo '------ building devices metadata bundle ...'
+	mkdir -p \
+	    $(BUILD_DIR)/$(CSTBOX_PACKAGES_INSTALL_DIR)/pycstbox
+	$(CHECK_META) -j $(CHECK_META_JOBS) $(CHECK_META_OPTS) \
+	    --bundle $(BUILD_DIR)/$(CSTBOX_PACKAGES_INSTALL_DIR)/pycstbox/$(DEVCFG_BUNDLE) \
+	    $(DEVCFG_FROM)
+
 
 copy_init_shared_files:
 	@echo '------ copying init scripts shared library...'
@@ -304,7 +324,7 @@ apply_patches:
 
 check_metadata_files:
 	@echo '----- checking metadata files...'
-	@for f in $$(find lib/python/pycstbox/devcfg.d/ -type f) ; do echo $$f ; cat $$f | python -mjson.tool > /dev/null || exit 1 ; done
+	$(CHECK_META) -j $(CHECK_META_JOBS) $(CHECK_META_OPTS) $(DEVCFG_FROM)
 
 upload: $(DEBPKG_NAME).deb
 	@if [ -z "$(CBX_DEPLOY_PATH)" ] ; then \
@@ -327,4 +347,4 @@ clean_deb:
 clean: clean_build clean_deb clean_java
 
 
-.PHONY: i18n dist deploy css clean clean_build clean_deb check_java_project_root update_version_info
+.PHONY: i18n dist deploy css clean clean_build clean_deb check_java_project_root update_version_info build_devices_metadata_bundle
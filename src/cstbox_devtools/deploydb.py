@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Deployment state database.
+
+Stores in a single SQLite file the deployment targets, the packages currently deployed
+on each of them, the history of all deployments and the statistics of the network links
+with the targets. The database is opened in WAL mode with a busy timeout, so that
+several deployment tools (e.g. CI jobs) can use it at the same time, each update being
+done in a transaction.
+
+Deployed packages are described by dictionaries with the following keys : target,
+package, digest (SHA-1 of the package file), version, file (package file name),
+deployed (deployment time, in seconds since the epoch) and via (name of the relay target
+which forwarded the package, None for direct uploads). digest and version can be None
+for packages imported from the status files of previous versions of the tools.
+
+Link statistics are described by dictionaries with the following keys : target, rtt
+(round trip time, in seconds), throughput (in bytes per second), rtt_updated and
+throughput_updated (time of their last measure, in seconds since the epoch) and updated
+(time of the last update of any of them). rtt and throughput, and their update times,
+can be None if not measured yet.
+"""
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+import os
+import json
+import time
+import sqlite3
+import threading
+
+DEFAULT_DB_NAME = 'deploy.db'
+BUSY_TIMEOUT = 30000
+
+SCHEMA_VERSION = 4
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS targets (
+    name TEXT PRIMARY KEY,
+    deploy_path TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS deployed (
+    target TEXT NOT NULL REFERENCES targets(name),
+    package TEXT NOT NULL,
+    digest TEXT,
+    version TEXT,
+    file TEXT,
+    deployed REAL NOT NULL,
+    via TEXT,
+    PRIMARY KEY (target, package)
+);
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    target TEXT NOT NULL,
+    package TEXT NOT NULL,
+    digest TEXT,
+    version TEXT,
+    file TEXT,
+    deployed REAL NOT NULL,
+    via TEXT
+);
+CREATE INDEX IF NOT EXISTS history_by_target ON history (target, deployed);
+CREATE INDEX IF NOT EXISTS history_by_package ON history (package, deployed);
+CREATE TABLE IF NOT EXISTS links (
+    target TEXT PRIMARY KEY REFERENCES targets(name),
+    rtt REAL,
+    throughput REAL,
+    updated REAL NOT NULL,
+    rtt_updated REAL,
+    throughput_updated REAL
+);
+"""
+
+# successive schema upgrades, indexed by the version they upgrade from
+_UPGRADES = {
+    1: [
+        'ALTER TABLE deployed ADD COLUMN via TEXT',
+        'ALTER TABLE history ADD COLUMN via TEXT'
+    ],
+    # new tables are created by the schema script
+    2: [],
+    # the RTT of the existing links is measured again, since the throughput updates
+    # refreshed its update time
+    3: [
+        'ALTER TABLE links ADD COLUMN rtt_updated REAL',
+        'ALTER TABLE links ADD COLUMN throughput_updated REAL',
+        'UPDATE links SET throughput_updated=updated WHERE throughput IS NOT NULL'
+    ]
+}
+
+_DEPLOYED_COLUMNS = ('target', 'package', 'digest', 'version', 'file', 'deployed', 'via')
+_INSERT_DEPLOYED = 'INSERT %%s INTO %%s (%s) VALUES (%s)' % (
+    ', '.join(_DEPLOYED_COLUMNS), ', '.join('?' * len(_DEPLOYED_COLUMNS))
+)
+
+_LINK_COLUMNS = ('target', 'rtt', 'throughput', 'rtt_updated', 'throughput_updated', 'updated')
+
+
+class DeployDB(object):
+    """ The deployment state database.
+
+    Instances can be shared between threads.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT / 1000., check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA busy_timeout=%d' % BUSY_TIMEOUT)
+        with self._lock, self._conn:
+            version = self._conn.execute('PRAGMA user_version').fetchone()[0]
+            has_tables = self._conn.execute(
+                "SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name='targets'"
+            ).fetchone()[0]
+            if has_tables:
+                for from_version in range(version or 1, SCHEMA_VERSION):
+                    for sql in _UPGRADES[from_version]:
+                        self._conn.execute(sql)
+            self._conn.executescript(_SCHEMA)
+            self._conn.execute('PRAGMA user_version=%d' % SCHEMA_VERSION)
+
+    def close(self):
+        self._conn.close()
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def _update(self, statements):
+        with self._lock, self._conn:
+            for sql, params in statements:
+                self._conn.execute(sql, params)
+
+    def targets(self):
+        """ Returns the list of the (name, deploy_path) of the targets, sorted by name.
+        """
+        return self._query('SELECT name, deploy_path FROM targets ORDER BY name')
+
+    def add_target(self, name, deploy_path):
+        """ Registers a target.
+
+        :raises ValueError: if the target already exists
+        """
+        try:
+            self._update([(
+                'INSERT INTO targets (name, deploy_path, created) VALUES (?, ?, ?)',
+                (name, deploy_path, time.time())
+            )])
+        except sqlite3.IntegrityError:
+            raise ValueError("target '%s' already exists" % name)
+
+    def deployed(self, target, package):
+        """ Returns the description of the package currently deployed on a target, or None
+        if never deployed.
+        """
+        rows = self._query(
+            'SELECT %s FROM deployed WHERE target=? AND package=?' % ', '.join(_DEPLOYED_COLUMNS),
+            (target, package)
+        )
+        return dict(zip(_DEPLOYED_COLUMNS, rows[0])) if rows else None
+
+    def deployed_packages(self, target):
+        """ Returns the descriptions of the packages currently deployed on a target, sorted
+        by package name.
+        """
+        return [dict(zip(_DEPLOYED_COLUMNS, row)) for row in self._query(
+            'SELECT %s FROM deployed WHERE target=? ORDER BY package' % ', '.join(_DEPLOYED_COLUMNS),
+            (target,)
+        )]
+
+    def record_deployment(self, target, package, digest, version, file_name, deployed=None, via=None):
+        """ Records the deployment of a package on a target, via a relay target if any.
+        """
+        values = (target, package, digest, version, file_name, deployed or time.time(), via)
+        self._update([
+            (_INSERT_DEPLOYED % ('OR REPLACE', 'deployed'), values),
+            (_INSERT_DEPLOYED % ('', 'history'), values)
+        ])
+
+    def clear(self, target):
+        """ Forgets the packages deployed on a target. Its history is kept.
+        """
+        self._update([('DELETE FROM deployed WHERE target=?', (target,))])
+
+    def history(self, target=None, package=None, limit=None):
+        """ Returns the descriptions of past deployments, most recent first, optionally
+        restricted to a target and/or a package.
+        """
+        where, params = [], []
+        if target:
+            where.append('target=?')
+            params.append(target)
+        if package:
+            where.append('package=?')
+            params.append(package)
+        sql = 'SELECT %s FROM history' % ', '.join(_DEPLOYED_COLUMNS)
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY deployed DESC, id DESC'
+        if limit:
+            sql += ' LIMIT %d' % limit
+        return [dict(zip(_DEPLOYED_COLUMNS, row)) for row in self._query(sql, params)]
+
+    def link_stats(self, target):
+        """ Returns the statistics of the link with a target, or None if never measured.
+        """
+        rows = self._query('SELECT %s FROM links WHERE target=?' % ', '.join(_LINK_COLUMNS), (target,))
+        return dict(zip(_LINK_COLUMNS, rows[0])) if rows else None
+
+    def record_link_stats(self, target, rtt=None, throughput=None):
+        """ Updates the statistics of the link with a target, and their update times.
+        Statistics passed as None are left unchanged.
+        """
+        now = time.time()
+        statements = [('INSERT OR IGNORE INTO links (target, updated) VALUES (?, ?)', (target, now))]
+        for column, value in (('rtt', rtt), ('throughput', throughput)):
+            if value is not None:
+                statements.append((
+                    'UPDATE links SET %s=?, %s_updated=?, updated=? WHERE target=?' % (column, column),
+                    (value, now, now, target)
+                ))
+        self._update(statements)
+
+    def import_legacy(self, targets_root, deploy_path_store, status_subdir):
+        """ Imports the targets stored as directories by previous versions of the tools,
+        with their status files, if they are not already known. Returns the names of the
+        imported targets.
+
+        Status files are either empty (the modification time being the deployment time)
+        or contain the JSON description of the deployed package.
+        """
+        known = set(name for name, _ in self.targets())
+        statements = []
+        imported = []
+        for name in sorted(os.listdir(targets_root)):
+            target_dir = os.path.join(targets_root, name)
+            store = os.path.join(target_dir, deploy_path_store)
+            if name in known or not os.path.exists(store):
+                continue
+
+            with open(store, 'rt') as fp:
+                deploy_path = fp.readline()
+            statements.append((
+                'INSERT INTO targets (name, deploy_path, created) VALUES (?, ?, ?)',
+                (name, deploy_path, os.path.getmtime(store))
+            ))
+
+            status_dir = os.path.join(target_dir, status_subdir)
+            for package in sorted(os.listdir(status_dir)) if os.path.isdir(status_dir) else []:
+                status_file = os.path.join(status_dir, package)
+                if package.endswith('.tmp') or not os.path.isfile(status_file):
+                    continue
+                with open(status_file, 'rt') as fp:
+                    content = fp.read()
+                try:
+                    status = json.loads(content) if content.strip() else {}
+                except ValueError:
+                    status = {}
+                values = (
+                    name, package, status.get('digest'), status.get('version'), status.get('file'),
+                    status.get('deployed') or os.path.getmtime(status_file), None
+                )
+                for table in ('deployed', 'history'):
+                    statements.append((_INSERT_DEPLOYED % ('', table), values))
+            imported.append(name)
+
+        if statements:
+            self._update(statements)
+        return imported
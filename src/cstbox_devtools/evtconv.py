@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" CSTBox event log conversion pipeline.
+
+A conversion is described as a sequence of stages, each one being a function taking a
+record (the list of the tab-separated fields of an event : timestamp, variable type,
+variable name, value, data) and returning it, possibly modified, or None to discard the
+event. The stages of a pipeline are fused in a single function, so that the conversion
+of a log needs only one split per line whatever the number of stages.
+
+Stages are created by factories registered under a name with the :py:func:`stage`
+decorator, and are specified as strings of the form ``name[:arg[,arg...]]``. Site
+specific stages can be provided by any module registering its own factories, e.g.::
+
+    from cstbox_devtools import evtconv
+
+    @evtconv.stage('celsius')
+    def to_celsius(pattern):
+        def apply(record):
+            ...
+            return record
+        return apply
+
+The default pipeline (:py:data:`V2_TO_V3_STAGES`) implements the CSTBox v2 to v3 log
+format conversion.
+"""
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+import json
+import fnmatch
+
+FIELDS_COUNT = 5
+
+_STAGE_FACTORIES = {}
+
+
+def stage(name):
+    """ Decorator registering a stage factory under the given name.
+
+    The factory is called with the string arguments of the stage specification and must
+    return the stage function.
+    """
+    def decorator(factory):
+        _STAGE_FACTORIES[name] = factory
+        return factory
+    return decorator
+
+
+def registered_stages():
+    return sorted(_STAGE_FACTORIES.keys())
+
+
+def make_stage(spec):
+    """ Returns the stage function corresponding to a ``name[:arg[,arg...]]`` specification.
+
+    :raises ValueError: if the stage is unknown or its arguments are invalid
+    """
+    name, _, args = spec.partition(':')
+    try:
+        factory = _STAGE_FACTORIES[name]
+    except KeyError:
+        raise ValueError('unknown conversion stage : %s' % name)
+    try:
+        return factory(*(args.split(',') if args else []))
+    except TypeError as e:
+        raise ValueError('invalid arguments for stage %s (%s)' % (name, e))
+
+
+@stage('strip_prefix')
+def strip_prefix(prefix):
+    """ Removes a prefix from variable names.
+    """
+    length = len(prefix)
+
+    def apply(record):
+        if record[2].startswith(prefix):
+            record[2] = record[2][length:]
+        return record
+    return apply
+
+
+@stage('qualify_name')
+def qualify_name():
+    """ Prefixes variable names with their type, as required by the v3 format.
+    """
+    def apply(record):
+        record[2] = '.'.join((record[1], record[2]))
+        return record
+    return apply
+
+
+@stage('data_to_json')
+def data_to_json():
+    """ Converts the v2 '{k=v,...}' data field into its JSON equivalent, keys being lower
+    cased.
+    """
+    def apply(record):
+        data = record[4].strip().strip('{}')
+        if data:
+            pairs = data.split(',')
+            record[4] = json.dumps(dict([(k.lower(), v) for k, v in (pair.split('=') for pair in pairs)]))
+        else:
+            record[4] = "{}"
+        return record
+    return apply
+
+
+@stage('rename')
+def rename(*mappings):
+    """ Renames variables, mappings being given as 'old=new' pairs or as the path of a JSON
+    file containing an {old: new} dictionary.
+    """
+    names = {}
+    for mapping in mappings:
+        if '=' in mapping:
+            old, new = mapping.split('=', 1)
+            names[old] = new
+        else:
+            with open(mapping, 'rt') as fp:
+                names.update((str(k), str(v)) for k, v in json.load(fp).iteritems())
+
+    def apply(record):
+        record[2] = names.get(record[2], record[2])
+        return record
+    return apply
+
+
+@stage('keep')
+def keep(*patterns):
+    """ Keeps only the events of the variables matching one of the given (shell style)
+    name patterns.
+    """
+    def apply(record):
+        name = record[2]
+        for pattern in patterns:
+            if fnmatch.fnmatchcase(name, pattern):
+                return record
+        return None
+    return apply
+
+
+@stage('drop')
+def drop(*patterns):
+    """ Discards the events of the variables matching one of the given name patterns.
+    """
+    def apply(record):
+        name = record[2]
+        for pattern in patterns:
+            if fnmatch.fnmatchcase(name, pattern):
+                return None
+        return record
+    return apply
+
+
+@stage('scale')
+def scale(pattern, factor, offset='0'):
+    """ Applies 'value * factor + offset' to the numeric values of the variables matching
+    the name pattern.
+    """
+    factor, offset = float(factor), float(offset)
+
+    def apply(record):
+        if fnmatch.fnmatchcase(record[2], pattern):
+            try:
+                record[3] = str(float(record[3]) * factor + offset)
+            except ValueError:
+                pass
+        return record
+    return apply
+
+
+V2_TO_V3_STAGES = (
+    # specific to Actility box at home files conversion
+    'strip_prefix:home.',
+    'qualify_name',
+    'data_to_json'
+)
+
+
+class Pipeline(object):
+    """ A sequence of conversion stages fused in a single record processing function.
+    """
+    def __init__(self, specs=V2_TO_V3_STAGES):
+        self.specs = list(specs)
+        functions = [make_stage(spec) for spec in self.specs]
+
+        def apply(record):
+            for function in functions:
+                record = function(record)
+                if record is None:
+                    return None
+            return record
+
+        self.apply = apply
+
+    def records(self, lines):
+        """ Generates the converted records of an iterable of lines, discarded events being
+        skipped.
+
+        :raises ValueError: if a line does not contain the expected number of fields
+        """
+        apply = self.apply
+        for line in lines:
+            record = line.split('\t')
+            if len(record) != FIELDS_COUNT:
+                raise ValueError('invalid record : %r' % line)
+            record = apply(record)
+            if record is not None:
+                yield record
+
+    def lines(self, lines):
+        """ Generates the converted lines (without terminator) of an iterable of lines.
+        """
+        for record in self.records(lines):
+            yield '\t'.join(record)
+
+    def convert(self, lines):
+        """ Returns the converted text of an iterable of lines.
+        """
+        return ''.join([line + '\n' for line in self.lines(lines)])
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" CSTBox v3 event log files access.
+
+Event logs are text files containing one event per line, made of the following
+tab-separated fields : timestamp, variable type, variable name, value, JSON data.
+
+A sparse index can be stored next to a log file (same path with '.idx' appended). It
+maps the timestamp of every Nth event to its offset in the file, so that the events of
+a time window can be read without scanning the file from its start. Since index lookup
+uses a binary search, it assumes that events are stored in chronological order, which is
+the case of the logs produced by CSTBox.
+"""
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+import os
+import struct
+import bisect
+import calendar
+import datetime
+import numbers
+
+INDEX_SUFFIX = '.idx'
+DEFAULT_INDEX_EVERY = 1000
+
+_INDEX_MAGIC = 'CBXIDX1\n'
+_INDEX_HEADER = struct.Struct('<I')
+_INDEX_ENTRY = struct.Struct('<dQ')
+
+
+def parse_timestamp(value):
+    """ Returns the number of seconds since the epoch corresponding to a timestamp.
+
+    The timestamp can be a datetime, a number or a string, containing either a number or
+    a date-time in ISO format (YYYY-MM-DD HH:MM:SS[.ffffff], with a space or a 'T' as
+    date and time separator, or YYYY-MM-DD for midnight). Naive date-times are considered
+    as UTC ones.
+
+    :raises ValueError: if the timestamp cannot be parsed
+    """
+    if isinstance(value, datetime.datetime):
+        return calendar.timegm(value.utctimetuple()) + value.microsecond / 1e6
+    if isinstance(value, numbers.Real):
+        return float(value)
+
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    value = value.strip()
+    try:
+        if len(value) == 10:
+            value += ' 00:00:00'
+        seconds = calendar.timegm((
+            int(value[0:4]), int(value[5:7]), int(value[8:10]),
+            int(value[11:13]), int(value[14:16]), int(value[17:19]),
+            0, 0, 0
+        ))
+        fraction = value[19:]
+        return seconds + float(fraction) if fraction else float(seconds)
+    except (ValueError, IndexError):
+        raise ValueError('invalid timestamp : %s' % value)
+
+
+def parse_value(value):
+    """ Returns the float value of an event value, or None if it is not numeric.
+
+    Boolean values (true and false, whatever their case) are considered as numeric ones,
+    and respectively valued 1 and 0.
+    """
+    try:
+        return float(value)
+    except ValueError:
+        return {'true': 1., 'false': 0.}.get(value.lower())
+
+
+class EventLogIndex(object):
+    """ The sparse timestamp index of an event log file.
+    """
+    def __init__(self, every, timestamps=None, offsets=None):
+        self.every = every
+        self.timestamps = timestamps or []
+        self.offsets = offsets or []
+
+    @classmethod
+    def load(cls, path):
+        """ Loads an index file.
+
+        :raises IOError: if the file cannot be read or is not an index file
+        """
+        with open(path, 'rb') as fp:
+            content = fp.read()
+        if not content.startswith(_INDEX_MAGIC):
+            raise IOError('not an event log index file : %s' % path)
+
+        pos = len(_INDEX_MAGIC)
+        every, = _INDEX_HEADER.unpack_from(content, pos)
+        pos += _INDEX_HEADER.size
+        count = (len(content) - pos) // _INDEX_ENTRY.size
+        fields = struct.unpack_from('<' + 'dQ' * count, content, pos)
+        return cls(every, list(fields[0::2]), list(fields[1::2]))
+
+    def offset_before(self, timestamp):
+        """ Returns the offset of the indexed event which is the closest one before the
+        given timestamp (expressed in seconds since the epoch), or 0 if none.
+        """
+        i = bisect.bisect_left(self.timestamps, timestamp) - 1
+        return self.offsets[i] if i >= 0 else 0
+
+    def __len__(self):
+        return len(self.offsets)
+
+
+class IndexWriter(object):
+    """ Builds the index of an event log file while it is written.
+
+    Converted text blocks are passed to :py:meth:`add` together with their offset in the
+    log file. When resuming the writing of an existing log file, resume_at is the log file
+    size from which events are going to be appended and records the number of events it
+    already contains. Index entries beyond resume_at are discarded in this case, and the
+    indexing period of the existing index is kept.
+    """
+    def __init__(self, path, every=DEFAULT_INDEX_EVERY, resume_at=None, records=0):
+        self.path = path
+        self.records = 0
+
+        if resume_at is not None and os.path.exists(path):
+            index = EventLogIndex.load(path)
+            self.every = index.every
+            self.records = records
+            entries = [
+                (ts, offset) for ts, offset in zip(index.timestamps, index.offsets) if offset < resume_at
+            ]
+        else:
+            self.every = every
+            entries = []
+
+        self._fp = open(path, 'wb')
+        self._fp.write(_INDEX_MAGIC + _INDEX_HEADER.pack(self.every))
+        for entry in entries:
+            self._fp.write(_INDEX_ENTRY.pack(*entry))
+
+    def add(self, text, offset):
+        """ Indexes a block of complete event lines, starting at the given offset of the
+        log file.
+        """
+        count = text.count('\n')
+        countdown = -self.records % self.every
+        if countdown >= count:
+            self.records += count
+            return
+
+        pos = 0
+        for _ in xrange(count):
+            if not countdown:
+                ts = text[pos:text.index('\t', pos)]
+                self._fp.write(_INDEX_ENTRY.pack(parse_timestamp(ts), offset + pos))
+                countdown = self.every
+            pos = text.index('\n', pos) + 1
+            countdown -= 1
+        self.records += count
+
+    def flush(self):
+        self._fp.flush()
+
+    def close(self):
+        self._fp.close()
+
+
+class EventLogReader(object):
+    """ Reads the events of a v3 log file, using its index if it has one to start reading
+    at the beginning of the requested time window.
+    """
+    def __init__(self, path):
+        self.path = path
+        try:
+            self.index = EventLogIndex.load(path + INDEX_SUFFIX)
+        except IOError:
+            self.index = None
+
+    def read(self, start=None, end=None):
+        """ Generates the lines (including their terminator) of the events with a timestamp
+        in the [start, end) interval.
+
+        Bounds are optional and can be provided in any form accepted by
+        :py:func:`parse_timestamp`.
+        """
+        start = parse_timestamp(start) if start is not None else None
+        end = parse_timestamp(end) if end is not None else None
+
+        with open(self.path, 'rb') as fp:
+            if start is not None and self.index:
+                fp.seek(self.index.offset_before(start))
+            for line in fp:
+                ts = parse_timestamp(line[:line.index('\t')])
+                if start is not None and ts < start:
+                    continue
+                if end is not None and ts >= end:
+                    break
+                yield line
+
+    def events(self, start=None, end=None):
+        """ Same as :py:meth:`read`, but generates the events as lists of their fields.
+        """
+        for line in self.read(start, end):
+            yield line.rstrip('\n').split('\t')
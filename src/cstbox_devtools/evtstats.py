@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Statistics profile of CSTBox event logs.
+
+A :py:class:`LogProfile` gathers, for each variable, its events count, time coverage,
+gaps between successive events and the minimum, maximum and mean of its numeric values
+(booleans being valued 0 and 1, see :py:func:`cstbox_devtools.evtlog.parse_value`).
+
+Records are accumulated by batches (typically the chunks processed by the conversion
+workers), the numeric computations of a batch being vectorized with NumPy when it is
+available. Profiles of successive batches are then combined with :py:meth:`merge`, which
+accounts for the gaps spanning batch boundaries.
+"""
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+import datetime
+
+from cstbox_devtools.evtlog import parse_timestamp, parse_value
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+DEFAULT_GAP_THRESHOLD = 3600
+
+
+def _iso(ts):
+    return datetime.datetime.utcfromtimestamp(ts).isoformat() if ts is not None else None
+
+
+class VariableProfile(object):
+    """ Statistics of a single variable.
+
+    head and tail are the timestamps of the first and last events in log order, while
+    first and last are the extreme timestamps, which differ for unsorted logs.
+    """
+    def __init__(self):
+        self.count = self.gaps = self.numeric = 0
+        self.max_gap = 0.
+        self.sum = 0.
+        self.head = self.tail = self.first = self.last = self.min = self.max = None
+
+    def add_batch(self, timestamps, values, gap_threshold):
+        """ Accumulates a batch of events, given as the lists of their timestamps (in
+        seconds) and of their raw values.
+        """
+        if np is not None:
+            ts = np.array(timestamps, dtype='float64')
+            gaps = np.diff(ts)
+            max_gap = float(gaps.max()) if len(gaps) else 0.
+            gaps_count = int((gaps > gap_threshold).sum())
+            first, last = float(ts.min()), float(ts.max())
+            try:
+                numbers = np.array(values, dtype='float64')
+            except ValueError:
+                numbers = np.array([_to_float(v) for v in values], dtype='float64')
+            numbers = numbers[~np.isnan(numbers)]
+            if len(numbers):
+                self._add_numbers(
+                    len(numbers), float(numbers.min()), float(numbers.max()), float(numbers.sum())
+                )
+        else:
+            gaps = [b - a for a, b in zip(timestamps, timestamps[1:])]
+            max_gap = max(gaps) if gaps else 0.
+            gaps_count = sum(1 for gap in gaps if gap > gap_threshold)
+            first, last = min(timestamps), max(timestamps)
+            numbers = [v for v in (_to_float(v) for v in values) if v == v]
+            if numbers:
+                self._add_numbers(len(numbers), min(numbers), max(numbers), sum(numbers))
+
+        other = VariableProfile()
+        other.count = len(timestamps)
+        other.head, other.tail = timestamps[0], timestamps[-1]
+        other.first, other.last = first, last
+        other.max_gap, other.gaps = max_gap, gaps_count
+        self._append(other, gap_threshold)
+
+    def _add_numbers(self, count, vmin, vmax, vsum):
+        self.numeric += count
+        self.sum += vsum
+        self.min = vmin if self.min is None else min(self.min, vmin)
+        self.max = vmax if self.max is None else max(self.max, vmax)
+
+    def _append(self, other, gap_threshold):
+        """ Combines the time related statistics of a profile of later events.
+        """
+        if self.count:
+            gap = other.head - self.tail
+            self.max_gap = max(self.max_gap, other.max_gap, gap)
+            self.gaps += other.gaps + (1 if gap > gap_threshold else 0)
+            self.first = min(self.first, other.first)
+            self.last = max(self.last, other.last)
+        else:
+            self.head, self.first, self.last = other.head, other.first, other.last
+            self.max_gap, self.gaps = other.max_gap, other.gaps
+        self.tail = other.tail
+        self.count += other.count
+
+    def merge(self, other, gap_threshold):
+        self._append(other, gap_threshold)
+        if other.numeric:
+            self._add_numbers(other.numeric, other.min, other.max, other.sum)
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'first': _iso(self.first),
+            'last': _iso(self.last),
+            'max_gap': self.max_gap,
+            'gaps': self.gaps,
+            'numeric': self.numeric,
+            'min': self.min,
+            'max': self.max,
+            'mean': self.sum / self.numeric if self.numeric else None
+        }
+
+
+def _to_float(value):
+    value = parse_value(value)
+    return float('nan') if value is None else value
+
+
+class LogProfile(object):
+    """ Statistics profile of a set of events.
+
+    Gaps are the intervals between successive events of a variable which are longer than
+    gap_threshold seconds.
+    """
+    def __init__(self, gap_threshold=DEFAULT_GAP_THRESHOLD):
+        self.gap_threshold = gap_threshold
+        self.variables = {}
+
+    def add_records(self, records):
+        """ Accumulates a batch of records (lists of the event fields).
+        """
+        batches = {}
+        for record in records:
+            try:
+                batch = batches[record[2]]
+            except KeyError:
+                batch = batches[record[2]] = ([], [])
+            batch[0].append(parse_timestamp(record[0]))
+            batch[1].append(record[3])
+
+        for name, (timestamps, values) in batches.iteritems():
+            try:
+                variable = self.variables[name]
+            except KeyError:
+                variable = self.variables[name] = VariableProfile()
+            variable.add_batch(timestamps, values, self.gap_threshold)
+
+    def merge(self, other):
+        """ Combines the profile of events following the ones of this profile.
+        """
+        for name, variable in other.variables.iteritems():
+            try:
+                self.variables[name].merge(variable, self.gap_threshold)
+            except KeyError:
+                self.variables[name] = variable
+
+    def as_dict(self):
+        variables = self.variables.values()
+        return {
+            'events': sum(v.count for v in variables),
+            'first': _iso(min(v.first for v in variables)) if variables else None,
+            'last': _iso(max(v.last for v in variables)) if variables else None,
+            'gap_threshold': self.gap_threshold,
+            'variables': dict((name, v.as_dict()) for name, v in self.variables.iteritems())
+        }
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Files manifests, used for mirroring incrementally the files of a target.
+
+A manifest describes the files of a directory tree, as a dictionary giving the size and
+the SHA-1 digest of the files, keyed by their path relative to the tree root.
+
+The manifests of several directories of a target (named areas) are obtained in a single
+round trip by running on the target the shell script produced by :py:func:`remote_script`,
+and then compared to the manifests of their local copies. The latter are computed by
+:py:func:`scan`, which uses a cache so that only the local files modified since the
+previous scan are hashed again.
+"""
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+import os
+import json
+import hashlib
+import pipes
+
+CACHE_FORMAT = 1
+
+
+def remote_script(areas, excluded=()):
+    """ Returns the shell script producing the manifests of a list of (name, directory)
+    areas, to be parsed by :py:func:`parse_remote`.
+
+    :param excluded: names of the top level sub-directories of the areas to be ignored
+    """
+    prune = ''.join('-path %s -prune -o ' % pipes.quote('./' + name) for name in excluded)
+    script = []
+    for name, path in areas:
+        script.append(
+            "if cd %(path)s 2>/dev/null ; then echo @ %(name)s ; "
+            "find . %(prune)s-type f -printf 'S %%s %%p\\n' ; find . %(prune)s-type f -exec sha1sum {} + ; "
+            "cd / ; else echo ! %(name)s ; fi" % {'path': pipes.quote(path), 'name': name, 'prune': prune}
+        )
+    return '\n'.join(script) + '\n'
+
+
+def parse_remote(output):
+    """ Parses the output of the script produced by :py:func:`remote_script` and returns
+    the dictionary of the manifests of the areas, keyed by area name. Areas which do not
+    exist on the target are given a None manifest.
+    """
+    manifests = {}
+    sizes = digests = None
+    for line in output.splitlines():
+        if line.startswith('@ '):
+            sizes, digests = {}, {}
+            manifests[line[2:]] = (sizes, digests)
+        elif line.startswith('! '):
+            sizes = digests = None
+            manifests[line[2:]] = None
+        elif sizes is None:
+            continue
+        elif line.startswith('S '):
+            size, path = line[2:].split(' ', 1)
+            sizes[_relative(path)] = int(size)
+        elif len(line) > 42 and line[40:42] == '  ':
+            digests[_relative(line[42:])] = line[:40]
+
+    for name, manifest in manifests.iteritems():
+        if manifest is not None:
+            sizes, digests = manifest
+            manifests[name] = dict(
+                (path, (size, digests.get(path))) for path, size in sizes.iteritems()
+            )
+    return manifests
+
+
+def _relative(path):
+    return path[2:] if path.startswith('./') else path
+
+
+def file_digest(path):
+    """ Returns the hexadecimal SHA-1 digest of the content of a file.
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(1 << 20), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def scan(root, cache):
+    """ Returns the manifest of a local directory tree.
+
+    :param str root: the tree root (it can be missing)
+    :param dict cache: the (size, mtime, digest) of the files, keyed by relative path,
+        as updated by the previous scan. It is updated in place.
+    """
+    manifest = {}
+    for dir_path, _, file_names in os.walk(root):
+        for file_name in file_names:
+            path = os.path.join(dir_path, file_name)
+            rel_path = os.path.relpath(path, root)
+            st = os.stat(path)
+            cached = cache.get(rel_path)
+            if cached and cached[0] == st.st_size and cached[1] == st.st_mtime:
+                digest = cached[2]
+            else:
+                digest = file_digest(path)
+            cache[rel_path] = (st.st_size, st.st_mtime, digest)
+            manifest[rel_path] = (st.st_size, digest)
+
+    for rel_path in set(cache) - set(manifest):
+        del cache[rel_path]
+    return manifest
+
+
+def diff(remote, local):
+    """ Compares a remote manifest to a local one, and returns the sorted lists of the
+    paths of the files which are new, changed, and missing on the remote side.
+    """
+    new = sorted(path for path in remote if path not in local)
+    changed = sorted(path for path in remote if path in local and remote[path] != local[path])
+    removed = sorted(path for path in local if path not in remote)
+    return new, changed, removed
+
+
+def load_cache(path):
+    """ Loads the scan caches of the areas stored in a file, returning an empty
+    dictionary if the file does not exist or is not usable.
+    """
+    try:
+        with open(path, 'rt') as fp:
+            data = json.load(fp)
+    except (IOError, ValueError):
+        return {}
+    if not isinstance(data, dict) or data.get('format') != CACHE_FORMAT:
+        return {}
+    return dict(
+        (area, dict((rel_path, tuple(entry)) for rel_path, entry in files.iteritems()))
+        for area, files in data.get('areas', {}).iteritems()
+    )
+
+
+def save_cache(path, caches):
+    """ Stores the scan caches of the areas in a file.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wt') as fp:
+        json.dump({'format': CACHE_FORMAT, 'areas': caches}, fp, separators=(',', ':'))
+    os.rename(tmp_path, path)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" SSH connections multiplexing for the deployment tools.
+
+Transfers to a remote target (rsync, ssh commands) can share a single SSH connection,
+so that the handshake cost is paid once per tool invocation instead of once per
+transfer. The first command run through the multiplexer opens the master connection,
+the next ones reuse it, and it is closed by :py:meth:`SSHMultiplexer.close`. Should the
+closing be missed (e.g. the tool is killed), the master connection exits by itself once
+idle for a while.
+
+Typical use::
+
+    with sshmux.for_path(deploy_path) as ssh:
+        subprocess.check_call('rsync -a %s %s %s' % (ssh.rsync_option, src, deploy_path), shell=True)
+"""
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+import os
+import shutil
+import tempfile
+import subprocess
+import pipes
+
+# idle time (in seconds) after which an orphan master connection exits
+DEFAULT_PERSIST = 120
+
+
+def is_daemon_path(path):
+    """ Tells if a rsync path is an rsync daemon one (host::module or rsync://host/module).
+    """
+    if path.startswith('rsync://'):
+        return True
+    host, sep, remainder = path.partition(':')
+    return bool(sep and host and '/' not in host and remainder.startswith(':'))
+
+
+def remote_host(path):
+    """ Returns the host part ([user@]host) of a remote rsync/scp path, or None if the
+    path is a local one or an rsync daemon one.
+    """
+    if is_daemon_path(path):
+        return None
+    host, sep, _ = path.partition(':')
+    if not sep or not host or '/' in host:
+        return None
+    return host
+
+
+class SSHMultiplexer(object):
+    """ Shares a multiplexed SSH connection to a host between the commands run through it.
+    """
+    def __init__(self, host, persist=DEFAULT_PERSIST):
+        self.host = host
+        # kept short, since the length of Unix sockets paths is limited
+        self._dir = tempfile.mkdtemp(prefix='cbx-ssh-')
+        self.control_path = os.path.join(self._dir, 'master')
+        self.options = [
+            '-o', 'ControlMaster=auto',
+            '-o', 'ControlPath=' + self.control_path,
+            '-o', 'ControlPersist=%d' % persist
+        ]
+
+    @property
+    def ssh_command(self):
+        """ The ssh command line to be used for connecting through the multiplexer.
+        """
+        return ' '.join(['ssh'] + [pipes.quote(opt) for opt in self.options])
+
+    @property
+    def rsync_option(self):
+        """ The rsync option making it connect through the multiplexer.
+        """
+        return '-e %s' % pipes.quote(self.ssh_command)
+
+    def close(self):
+        """ Closes the master connection if it has been opened.
+        """
+        if self._dir is None:
+            return
+        if os.path.exists(self.control_path):
+            with open(os.devnull, 'wb') as devnull:
+                subprocess.call(
+                    ['ssh', '-o', 'ControlPath=' + self.control_path, '-O', 'exit', self.host],
+                    stdout=devnull, stderr=devnull
+                )
+        shutil.rmtree(self._dir, ignore_errors=True)
+        self._dir = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class _LocalTarget(object):
+    """ Stands for a multiplexer when the target is local.
+    """
+    host = None
+    ssh_command = 'ssh'
+    rsync_option = ''
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+def for_path(path, persist=DEFAULT_PERSIST):
+    """ Returns the multiplexer to be used for transfers to a deployment path, which does
+    nothing if the path is a local one.
+    """
+    host = remote_host(path)
+    return SSHMultiplexer(host, persist) if host else _LocalTarget()
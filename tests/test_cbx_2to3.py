@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+""" Regression tests of the error handling of cbx-2to3.py. """
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+import os
+import sys
+import gzip
+import json
+import shutil
+import tempfile
+import subprocess
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT, 'bin', 'cbx-2to3.py')
+
+
+def v2_lines(count, start=0):
+    return ''.join(
+        '2015-01-01 %02d:%02d:%02d\ttemperature\thome.t%d\t%d.5\t\n' % (
+            i // 3600 % 24, i // 60 % 60, i % 60, i % 3, i
+        ) for i in range(start, start + count)
+    )
+
+
+class Cbx2to3ErrorsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='test-cbx-2to3-')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def write_gz(self, name, text):
+        with gzip.open(self.path(name), 'wb') as fp:
+            fp.write(text)
+        return self.path(name)
+
+    def write_corrupt_gz(self, name, text):
+        path = self.write_gz(name, text)
+        with open(path, 'rb') as fp:
+            data = fp.read()
+        with open(path, 'wb') as fp:
+            fp.write(data[:20] + 'x' * 200 + data[220:])
+        return path
+
+    def write_truncated_gz(self, name, text):
+        path = self.write_gz(name, text)
+        with open(path, 'rb') as fp:
+            data = fp.read()
+        with open(path, 'wb') as fp:
+            fp.write(data[:len(data) // 2])
+        return path
+
+    def write(self, name, text):
+        with open(self.path(name), 'wb') as fp:
+            fp.write(text)
+        return self.path(name)
+
+    def run_script(self, *args):
+        env = dict(os.environ, PYTHONPATH=os.path.join(ROOT, 'src'))
+        process = subprocess.Popen(
+            [sys.executable, SCRIPT] + list(args),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env
+        )
+        _, errors = process.communicate()
+        return process.returncode, errors
+
+    def assert_fails(self, args, message):
+        for jobs in ('1', '2'):
+            rc, errors = self.run_script('-j', jobs, *args)
+            self.assertEqual(rc, 2, '-j %s: rc=%d, stderr=%s' % (jobs, rc, errors))
+            self.assertIn(message, errors)
+
+    def test_corrupt_compressed_input(self):
+        corrupt = self.write_corrupt_gz('corrupt.log.gz', v2_lines(20000))
+        self.assert_fails([corrupt, '-o', self.path('out.log')], corrupt)
+
+    def test_corrupt_compressed_input_followed_by_good_one(self):
+        corrupt = self.write_corrupt_gz('corrupt.log.gz', v2_lines(20000))
+        good = self.write_gz('good.log.gz', v2_lines(100))
+        self.assert_fails([corrupt, good, '-o', self.path('out.log')], corrupt)
+
+    def test_truncated_compressed_input(self):
+        truncated = self.write_truncated_gz('truncated.log.gz', v2_lines(20000))
+        self.assert_fails([truncated, '-o', self.path('out.log')], truncated)
+
+    def test_merge_invalid_record(self):
+        good = self.write('good.log', v2_lines(100))
+        bad = self.write('bad.log', v2_lines(50) + 'not a record\n' + v2_lines(50, 50))
+        self.assert_fails(['-m', good, bad, '-o', self.path('out.log')], bad)
+
+    def test_merge_corrupt_compressed_input(self):
+        good = self.write('good.log', v2_lines(100))
+        corrupt = self.write_corrupt_gz('corrupt.log.gz', v2_lines(20000))
+        self.assert_fails(['-m', good, corrupt, '-o', self.path('out.log')], corrupt)
+
+    def test_merge(self):
+        first = self.write('first.log', v2_lines(100))
+        second = self.write('second.log', v2_lines(100, 100))
+        out = self.path('out.log')
+        rc, errors = self.run_script('-j', '2', '-m', second, first, '-o', out)
+        self.assertEqual(rc, 0, errors)
+        with open(out, 'rb') as fp:
+            timestamps = [line.split('\t', 1)[0] for line in fp]
+        self.assertEqual(len(timestamps), 200)
+        self.assertEqual(timestamps, sorted(timestamps))
+
+    def test_directory_checkpoint_not_saved_for_failed_file(self):
+        src, dst = self.path('src'), self.path('dst')
+        os.mkdir(src)
+        self.write_gz('src/a.log.gz', v2_lines(100))
+        self.write_corrupt_gz('src/b.log.gz', v2_lines(20000))
+        for jobs in ('1', '2'):
+            rc, errors = self.run_script('-j', jobs, '-d', src, '-o', dst)
+            self.assertEqual(rc, 2, errors)
+            with open(os.path.join(dst, '.cbx-2to3.checkpoint')) as fp:
+                checkpoint = json.load(fp)
+            self.assertFalse(checkpoint.get('b.log.gz', {}).get('size'))
+
+        # the file is converted once repaired
+        self.write_gz('src/b.log.gz', v2_lines(100, 100))
+        rc, errors = self.run_script('-d', src, '-o', dst)
+        self.assertEqual(rc, 0, errors)
+        with open(os.path.join(dst, 'b.log')) as fp:
+            self.assertEqual(len(fp.readlines()), 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+""" Tests of check-meta.py. """
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+import os
+import sys
+import imp
+import shutil
+import json
+import tempfile
+import subprocess
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT, 'bin', 'check-meta.py')
+
+check_meta = imp.load_source('check_meta', SCRIPT)
+
+ACCENTED_META = '''{
+    "productname": "Capteur température",
+    "pdefs": {
+        "root": {
+            "température": {
+                "label": "Température intérieure",
+                "type": 5
+            }
+        },
+        "outputs": {}
+    }
+}
+'''
+
+
+class CheckMetaTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='test-check-meta-')
+        check_meta.set_validator(check_meta.DEFAULT_SCHEMA_PATH)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, text):
+        path = os.path.join(self.dir, name)
+        with open(path, 'wb') as fp:
+            fp.write(text)
+        return path
+
+    def test_accented_labels(self):
+        path = self.write('capteur.json', ACCENTED_META)
+        errors, meta, _ = check_meta.check_file(path)
+        self.assertIsNone(meta)
+        self.assertEqual(len(errors), 1)
+        error = errors[0]
+        self.assertEqual((error.line, error.column), (7, 17))
+        self.assertEqual(
+            str(error),
+            '%s:7:17: /pdefs/root/température/type: expected string, got int' % path
+        )
+
+    def test_accented_labels_output(self):
+        path = self.write('capteur.json', ACCENTED_META)
+        process = subprocess.Popen(
+            [sys.executable, SCRIPT, '--no-cache', path],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+        )
+        output, _ = process.communicate()
+        self.assertEqual(process.returncode, 1, output)
+        self.assertIn('/pdefs/root/température/type: expected string', output)
+
+    def test_attic_excluded(self):
+        os.makedirs(os.path.join(self.dir, 'modbus.d', 'attic'))
+        valid = '{"productname": "x", "pdefs": {"root": {}, "outputs": {}}}'
+        current = self.write('modbus.d/rhf3201', valid)
+        self.write('modbus.d/attic/rhf3200', '{"obsolete": true}')
+        self.assertEqual(check_meta.expand_paths([self.dir]), [current])
+
+        bundle = os.path.join(self.dir, '.bundle.json')
+        process = subprocess.Popen(
+            [sys.executable, SCRIPT, '--no-cache', '--bundle', bundle, self.dir],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+        )
+        output, _ = process.communicate()
+        self.assertEqual(process.returncode, 0, output)
+        with open(bundle, 'rt') as fp:
+            self.assertEqual(json.load(fp)['paths'], {'modbus:rhf3201': 'modbus.d/rhf3201'})
+
+
+if __name__ == '__main__':
+    unittest.main()
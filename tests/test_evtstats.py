@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+""" Tests of cstbox_devtools.evtstats. """
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+from cstbox_devtools import evtlog, evtstats
+
+RECORDS = [
+    ['2015-01-01 00:00:00', 'opened', 'home.door', 'true', ''],
+    ['2015-01-01 00:01:00', 'opened', 'home.door', 'False', ''],
+    ['2015-01-01 00:02:00', 'opened', 'home.door', 'TRUE', ''],
+    ['2015-01-01 00:03:00', 'opened', 'home.door', 'unknown', ''],
+]
+
+
+class LogProfileTestCase(unittest.TestCase):
+    def check_booleans(self):
+        profile = evtstats.LogProfile()
+        profile.add_records(RECORDS)
+        door = profile.as_dict()['variables']['home.door']
+        # classified as in the columnar output
+        self.assertEqual(door['numeric'], sum(1 for r in RECORDS if evtlog.parse_value(r[3]) is not None))
+        self.assertEqual((door['numeric'], door['min'], door['max']), (3, 0., 1.))
+        self.assertAlmostEqual(door['mean'], 2. / 3)
+
+    def test_booleans(self):
+        self.check_booleans()
+
+    def test_booleans_without_numpy(self):
+        np, evtstats.np = evtstats.np, None
+        try:
+            self.check_booleans()
+        finally:
+            evtstats.np = np
+
+
+if __name__ == '__main__':
+    unittest.main()